@@ -1,5 +1,19 @@
+import bisect
+import hashlib
+import inspect
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
-from typing import Union, List, Optional
+import re
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from typing import Union, List, Optional, Tuple, Sequence, Callable, Iterator, Iterable, TextIO, NamedTuple
 
 alphabet_chars = list("abcdefghijklmnopqrstuvwxyz") + list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
 numeric_chars = list("0123456789")
@@ -18,6 +32,17 @@ def read_lines_from_txt(fp: Union[str, os.PathLike]) -> List[str]:
     with open(fp, "r") as f:
         return [line.strip() for line in f.readlines()]
 
+def iter_lines_from_txt(fp: Union[str, os.PathLike]) -> Iterator[str]:
+    """
+    Streaming version of read_lines_from_txt, only one line is held in memory at a time.
+    :param fp: File path of the .txt file.
+    :return: A generator of the lines of the file path removing trailing whitespaces
+    and newline characters.
+    """
+    with open(fp, "r") as f:
+        for line in f:
+            yield line.strip()
+
 def is_valid_var_name(s: str) -> bool:
     """
     :param s: Candidate input variable name
@@ -46,6 +71,26 @@ class Node:
     def add_child_node(self, node: 'Node') -> None:
         self.children.append(node)
 
+class SpanNode(Node):
+    """
+    Node whose elem is the slice tokens[start:end] of a token sequence shared by the whole
+    tree. The list is only built when elem is read.
+    Attributes:
+        tokens: the shared token sequence
+        start: index of the first token of elem
+        end: index just past the last token of elem
+        children: a list of child nodes
+    """
+    def __init__(self, tokens: Sequence[str], start: int, end: int):
+        self.tokens = tokens
+        self.start = start
+        self.end = end
+        self.children = []
+
+    @property
+    def elem(self) -> List[str]:
+        return list(self.tokens[self.start:self.end])
+
 class ParseTree:
     """
     A full parse tree, with nodes
@@ -56,25 +101,88 @@ class ParseTree:
         self.root = root
 
     def print_tree(self, node: Optional[Node] = None, level: int = 0) -> None:
-        #start from the root
+        #start from the root, the whole tree is printed with one write
+        print(self.render(node=node, level=level), end="")
+
+    def render(self, out: Optional[TextIO] = None, node: Optional[Node] = None, level: int = 0) -> str:
+        """
+        Renders the text print_tree prints into one string
+        :param out: If given, the text is written to it with a single write call
+        :param node: The node to start from, defaults to the root
+        :param level: The indentation level of node, the blank header lines are only
+        rendered at level 0
+        :return: The rendered text
+        """
         if node is None:
             node = self.root
-        if level == 0:
-            print("\n" * 3, end="")
+        parts = ["\n" * 3] if level == 0 else []
+
+        # Depth first with an explicit stack, so deep trees don't hit the recursion limit
+        stack = [(node, level)]
+        while stack:
+            node, level = stack.pop()
+
+            # Join the elements of the node to form a single string, using '_' as a separator
+            node_str = "_".join(node.elem)
+            if node_str !="":
+                parts.append("----" * level + node_str + "\n")
+
+            # Children are pushed in reverse so the first child is rendered first
+            for child in reversed(node.children):
+                stack.append((child, level + 1))
+
+        text = "".join(parts)
+        if out is not None:
+            out.write(text)
+        return text
 
-        # Join the elements of the node to form a single string, using '_' as a separator
-        node_str = "_".join(node.elem)
 
-        # Print the current node
-        if node_str !="":
-            print("----" * level + node_str)
+def render_trees(trees: Iterable[ParseTree], out: TextIO, batch_size: Optional[int] = None) -> None:
+    """
+    Renders many trees into one output stream, as consecutive print_tree calls would.
+    :param trees: The trees to render
+    :param out: The writable text stream
+    :param batch_size: Number of trees rendered per write call, all at once if None
+    """
+    parts = []
+    for tree in trees:
+        parts.append(tree.render())
+        if batch_size is not None and len(parts) >= batch_size:
+            out.write("".join(parts))
+            parts = []
+    if parts:
+        out.write("".join(parts))
+
 
-        # Recursively print each child node
-        for child in node.children:
-            self.print_tree(child, level + 1)
 
 
 
+bracket_re = re.compile(r"[()]")
+
+
+def match_brackets(s: str) -> Tuple[List[int], int]:
+    """
+    One pass over the brackets of s, done once before tokenizing so that the bracket
+    diagnostics don't rescan the rest of the string at every '('.
+    :param s: The input string
+    :return: A list where entry i is the index of the bracket matching s[i] (-1 if s[i] is
+    not a bracket or is unmatched), and the index of the last ')' in s (-1 if none).
+    """
+    match = [-1] * len(s)
+    stack = []
+    last_close = -1
+    for m in bracket_re.finditer(s):
+        i = m.start()
+        if s[i] == '(':
+            stack.append(i)
+        else:
+            last_close = i
+            if stack:
+                j = stack.pop()
+                match[i] = j
+                match[j] = i
+    return match, last_close
+
 
 def parse_tokens(s_: str) -> Union[List[str], bool]:
     """
@@ -90,7 +198,7 @@ def parse_tokens(s_: str) -> Union[List[str], bool]:
     s = s_.strip() 
     tokens = []
     i = 0
-    open_brackets = 0  #track open parentheses
+    bracket_match, last_close = match_brackets(s)  #one pass bracket analysis
     last_token_was_lambda = False  #track if the last token was a lambda
     dot_opened_paren = False  #track if a parenthesis was opened by a dot
     error_a = error_b = error_c = error_d = error_e = error_f = None  #initialize error variables
@@ -146,7 +254,6 @@ def parse_tokens(s_: str) -> Union[List[str], bool]:
             last_token_was_lambda = False
 
         elif s[i] == '(':  # Opening parenthesis
-            open_brackets += 1
             tokens.append('(')
             i += 1
             last_token_was_lambda = False
@@ -157,16 +264,15 @@ def parse_tokens(s_: str) -> Union[List[str], bool]:
                 return False
 
             #Check if the entire string will have a matching closing parenthesis
-            if ')' not in s[i:]:
+            if last_close < i:
                 print(f"Bracket ( at index {i - 1} is not matched with a closing bracket ')'.")
                 return False
 
         elif s[i] == ')':  # Closing parenthesis
-            if open_brackets == 0:
+            if bracket_match[i] < 0:
                 print(f"Bracket ) at index {i} is not matched with an opening bracket '('.")
                 return False
             tokens.append(')')
-            open_brackets -= 1
             i += 1
             last_token_was_lambda = False
 
@@ -242,35 +348,515 @@ def parse_tokens(s_: str) -> Union[List[str], bool]:
 
     return tokens
 
-def read_lines_from_txt_check_validity(fp: Union[str, os.PathLike]) -> None:
+
+# Character classes for the table-driven scanner
+CC_OTHER, CC_ALPHA, CC_DIGIT, CC_LAMBDA, CC_LPAREN, CC_RPAREN, CC_DOT, CC_SPACE = range(8)
+char_classes = {c: CC_ALPHA for c in alphabet_chars}
+char_classes.update({c: CC_DIGIT for c in numeric_chars})
+char_classes.update({"\\": CC_LAMBDA, "(": CC_LPAREN, ")": CC_RPAREN, ".": CC_DOT, " ": CC_SPACE})
+var_run_re = re.compile(r"[A-Za-z0-9]*")
+
+
+# Error codes of tokenize, with the message each one is reported with
+error_messages = {
+    "empty": "Empty expression.",
+    "lambda_space": "Invalid space inserted after \\ at index {index}.",
+    "lambda_no_var": "Backslash not followed by a variable name at index {index}.",
+    "invalid_var": "Invalid variable name '{detail}'.",
+    "lambda_no_body": "Invalid lambda expression at {index}.",
+    "lambda_at_end": "Missing complete lambda expression starting at index {index}.",
+    "empty_parens": "Missing expression for parenthesis at index {index}.",
+    "unclosed_bracket": "Bracket ( at index {index} is not matched with a closing bracket ')'.",
+    "unopened_bracket": "Bracket ) at index {index} is not matched with an opening bracket '('.",
+    "no_var_before_dot": "Must have a variable name before character '.' at index {index}.",
+    "invalid_dot": "Encountered dot at invalid index {index}.",
+    "digit_start": "Error at index {index}, variables cannot begin with digits.",
+    "invalid_char": "Error at index {index} with invalid character {detail}.",
+}
+
+
+class TokenizeResult(NamedTuple):
+    """
+    Outcome of tokenizing one string. Results are immutable, so they can be shared
+    between callers. The error message is only formatted when read.
+    Attributes:
+        tokens: the list of tokens, or None if the string is invalid
+        error: the error code, a key of error_messages, or None if the string is valid
+        index: the index the error message refers to
+        detail: the variable name or character the error message refers to
+    """
+    tokens: Optional[Sequence[str]] = None
+    error: Optional[str] = None
+    index: int = -1
+    detail: str = ""
+
+    def __bool__(self) -> bool:
+        return self.error is None
+
+    @property
+    def message(self) -> Optional[str]:
+        if self.error is None:
+            return None
+        return error_messages[self.error].format(index=self.index, detail=self.detail)
+
+
+def tokenize(s_: str) -> TokenizeResult:
+    """
+    Same tokenizer as parse_tokens, but characters are classified with one dict lookup
+    in char_classes and variable names are consumed with a precompiled regex, instead of
+    scanning the alphabet_chars / var_chars lists for every character. Nothing is printed,
+    errors are returned as a code and an index.
+    :param s_: the input string
+    :return: A TokenizeResult holding the tokens, or the error of an invalid input
+    """
+    s = s_.strip()
+    n = len(s)
+    if n == 0:
+        return TokenizeResult(error="empty")
+    classes = char_classes
+    match_var = var_run_re.match
+    bracket_match, last_close = match_brackets(s)
+    tokens = []
+    i = 0
+    last_token_was_lambda = False
+    dot_opened_paren = False
+    error_c = error_d = error_e = error_f = None
+
+    while i < n:
+        cc = classes.get(s[i], CC_OTHER)
+        if cc == CC_LAMBDA:
+            tokens.append('\\')
+            last_token_was_lambda = True
+            i += 1
+
+            if i < n:
+                nc = classes.get(s[i], CC_OTHER)
+                if nc == CC_SPACE:
+                    error_e = TokenizeResult(error="lambda_space", index=i - 1)
+                    break
+                if nc != CC_ALPHA:
+                    error_f = TokenizeResult(error="lambda_no_var", index=i - 1)
+                    break
+
+            var_start = i
+            i = match_var(s, i).end()
+            var_name = s[var_start:i]
+            if not var_name:
+                error_c = TokenizeResult(error="invalid_var", detail=var_name)
+            tokens.append(var_name)
+
+            if i >= n:
+                error_d = TokenizeResult(error="lambda_no_body", index=var_start - 1)
+            elif s[i] == ' ':
+                i += 1
+                if i >= n:
+                    error_d = TokenizeResult(error="lambda_no_body", index=var_start - 1)
+
+        elif cc == CC_ALPHA:
+            var_start = i
+            i = match_var(s, i).end()
+            tokens.append(s[var_start:i])
+            last_token_was_lambda = False
+
+        elif cc == CC_LPAREN:
+            tokens.append('(')
+            i += 1
+            last_token_was_lambda = False
+            if i < n and s[i] == ')':
+                return TokenizeResult(error="empty_parens", index=i - 1)
+            if last_close < i:
+                return TokenizeResult(error="unclosed_bracket", index=i - 1)
+
+        elif cc == CC_RPAREN:
+            if bracket_match[i] < 0:
+                return TokenizeResult(error="unopened_bracket", index=i)
+            tokens.append(')')
+            i += 1
+            last_token_was_lambda = False
+
+        elif cc == CC_DOT:
+            if i > 0 and classes.get(s[i - 1], CC_OTHER) != CC_ALPHA:
+                return TokenizeResult(error="no_var_before_dot", index=i - 1)
+            if not last_token_was_lambda:
+                return TokenizeResult(error="invalid_dot", index=i)
+            tokens.append('(')
+            dot_opened_paren = True
+            i += 1
+            last_token_was_lambda = False
+
+        elif cc == CC_SPACE:
+            if i + 1 < n and s[i + 1] == '.':
+                return TokenizeResult(error="no_var_before_dot", index=i - 1)
+            i += 1
+
+        else:
+            if cc == CC_DIGIT:
+                return TokenizeResult(error="digit_start", index=i)
+            return TokenizeResult(error="invalid_char", index=i, detail=s[i])
+
+    if s[n - 1] == '\\':
+        return TokenizeResult(error="lambda_at_end", index=n - 1)
+
+    for error in (error_c, error_d, error_e, error_f):
+        if error is not None:
+            return error
+
+    if dot_opened_paren:
+        tokens.append(')')
+
+    return TokenizeResult(tokens)
+
+
+def parse_tokens_table(s_: str) -> Union[List[str], bool]:
+    """
+    parse_tokens-compatible wrapper of tokenize, prints the error message of invalid inputs.
+    :param s_: the input string
+    :return: A List of tokens (strings) if a valid input, otherwise False
+    """
+    result = tokenize(s_)
+    if result.error is not None:
+        print(result.message)
+        return False
+    return result.tokens
+
+
+# Ids of the structural tokens in every SymbolTable, variables get the ids after them
+LAMBDA_ID, LPAREN_ID, RPAREN_ID = range(3)
+
+
+class SymbolTable:
+    """
+    Maps tokens to small integer ids, so token lists and trees can hold one int per
+    token instead of a string. '\\', '(' and ')' always have the ids LAMBDA_ID,
+    LPAREN_ID and RPAREN_ID, variable names are numbered in order of first use.
+    Attributes:
+        names: the token of each id
+        ids: the id of each token
+    """
+    def __init__(self):
+        self.names = ['\\', '(', ')']
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def intern(self, name: str) -> int:
+        """
+        :return: The id of name, a new one if name wasn't seen before
+        """
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.names.append(name)
+            self.ids[name] = i
+        return i
+
+    def encode(self, tokens: Iterable[str]) -> array:
+        """
+        :return: The ids of tokens as an array('i')
+        """
+        return array('i', [self.intern(t) for t in tokens])
+
+    def decode(self, ids: Iterable[int]) -> List[str]:
+        """
+        :return: The tokens of ids
+        """
+        names = self.names
+        return [names[i] for i in ids]
+
+    @staticmethod
+    def is_variable(i: int) -> bool:
+        return i > RPAREN_ID
+
+
+def tokenize_ids(s_: str, symbols: SymbolTable) -> TokenizeResult:
+    """
+    Same as tokenize, but the tokens of a valid input are returned as an array('i') of
+    their ids in symbols.
+    :param s_: the input string
+    :param symbols: The SymbolTable the variable names are added to
+    :return: A TokenizeResult holding the token ids, or the error of an invalid input
+    """
+    result = tokenize(s_)
+    if result.tokens is not None:
+        result = result._replace(tokens=symbols.encode(result.tokens))
+    return result
+
+
+# Edits made only of these characters can't change bracket, dot or lambda structure
+lexical_only_re = re.compile(r"[A-Za-z0-9 ]*")
+structural_chars = "().\\"
+
+
+def token_offsets(s_: str, tokens: Sequence[str]) -> List[int]:
+    """
+    :param s_: A valid input string
+    :param tokens: The tokens of s_
+    :return: The index in s_ where each token starts. A '(' that replaces a dot starts at
+    the dot, and the ')' added at the end for it starts at the end of the stripped string.
+    """
+    pos = len(s_) - len(s_.lstrip())
+    end = len(s_.rstrip())
+    offsets = []
+    for t in tokens:
+        while pos < end and s_[pos] == ' ':
+            pos += 1
+        offsets.append(pos)
+        pos += 1 if t in ('(', ')') else len(t)
+    return offsets
+
+
+class IncrementalTokenizer:
+    """
+    Keeps the tokens of a string up to date while it is edited. An edit that only
+    changes variable names and spaces is re-lexed in the stretch of names and spaces
+    around it, up to the nearest bracket, dot or lambda character on either side. Any
+    other edit, or one whose result could be an error, re-tokenizes the whole string.
+    Attributes:
+        text: the current string
+        result: the TokenizeResult of text
+        offsets: the index in text of each token, if text is valid
+        incremental_edits: number of edits handled by re-lexing a stretch
+        full_tokenizations: number of times the whole text was tokenized
+    """
+    def __init__(self, text: str = ""):
+        self.incremental_edits = 0
+        self.full_tokenizations = 0
+        self.set_text(text)
+
+    def set_text(self, text: str) -> TokenizeResult:
+        """
+        Tokenizes the whole of text
+        """
+        self.full_tokenizations += 1
+        self.text = text
+        self.result = tokenize(text)
+        self.offsets = token_offsets(text, self.result.tokens) if self.result else None
+        return self.result
+
+    def edit(self, offset: int, deleted: int, inserted: str) -> TokenizeResult:
+        """
+        Replaces text[offset:offset + deleted] with inserted
+        :return: The TokenizeResult of the edited text
+        """
+        old = self.text
+        if offset < 0 or deleted < 0 or offset + deleted > len(old):
+            raise ValueError(f"Edit at {offset} deleting {deleted} is outside of a text of length {len(old)}.")
+        new = old[:offset] + inserted + old[offset + deleted:]
+        if (self.result and lexical_only_re.fullmatch(inserted)
+                and lexical_only_re.fullmatch(old, offset, offset + deleted)):
+            if self.relex(new, offset, offset + len(inserted), len(inserted) - deleted):
+                self.incremental_edits += 1
+                return self.result
+        return self.set_text(new)
+
+    def relex(self, new: str, edit_start: int, edit_end: int, shift: int) -> bool:
+        """
+        Re-lexes the stretch of names and spaces of new around new[edit_start:edit_end].
+        :param shift: How much the edit moved the text after it
+        :return: True if the tokens were updated, False if the whole text must be tokenized
+        """
+        start = edit_start
+        while start > 0 and new[start - 1] not in structural_chars and lexical_only_re.fullmatch(new[start - 1]):
+            start -= 1
+        end = edit_end
+        while end < len(new) and new[end] not in structural_chars and lexical_only_re.fullmatch(new[end]):
+            end += 1
+        at_start = start == 0
+        at_end = end == len(new)
+        before = None if at_start else new[start - 1]
+        after = None if at_end else new[end]
+        if (before is not None and before not in structural_chars) or \
+                (after is not None and after not in structural_chars):
+            return False  # Stopped at other whitespace, e.g. a tab
+        names = [(m.start(), m.group()) for m in var_run_re.finditer(new, start, end) if m.group()]
+        if not names or any(char_classes[name[0]] != CC_ALPHA for _, name in names):
+            return False
+        if before == '\\':
+            # The lambda variable follows the backslash directly and needs a body after it
+            if new[start] == ' ' or (at_end and len(names) < 2):
+                return False
+        if after == '.' and (before != '\\' or len(names) != 1
+                             or char_classes.get(new[end - 1]) != CC_ALPHA):
+            return False
+
+        # Tokens that started in the stretch before the edit are replaced by the names
+        tokens = list(self.result.tokens)
+        first = bisect.bisect_left(self.offsets, start)
+        if at_end:
+            # Only the ')' closing a dot can follow, it starts at the end of the stripped text
+            last = len(tokens)
+            if tokens[-1] == ')' and self.offsets[-1] >= start:
+                last -= 1
+            after_offsets = [len(new.rstrip())] * (len(tokens) - last)
+        else:
+            last = bisect.bisect_left(self.offsets, end - shift)
+            after_offsets = [pos + shift for pos in self.offsets[last:]]
+        tokens[first:last] = [name for _, name in names]
+        offsets = self.offsets[:first] + [pos for pos, _ in names] + after_offsets
+        self.text = new
+        self.result = TokenizeResult(tokens)
+        self.offsets = offsets
+        return True
+
+
+# Tokenizer engines that can be selected by name
+tokenizer_engines = {
+    "loop": parse_tokens,
+    "table": parse_tokens_table,
+}
+
+
+def get_tokenizer(engine: str = "loop"):
+    """
+    :param engine: Name of the tokenizer engine, one of tokenizer_engines
+    :return: The parse_tokens-compatible function for that engine
+    """
+    if engine not in tokenizer_engines:
+        raise ValueError(f"Unknown tokenizer engine '{engine}', expected one of {sorted(tokenizer_engines)}.")
+    return tokenizer_engines[engine]
+
+def validity_text(line: str, result: TokenizeResult) -> str:
+    """
+    :return: What checking the validity of line prints for its tokenize result
+    """
+    if result:
+        return f"The tokenized string for input string '{line}' is {'_'.join(result.tokens)}"
+    return result.message
+
+
+def read_lines_from_txt_check_validity(fp: Union[str, os.PathLike],
+                                       cache: Union['ParseCache', 'DiskParseCache', None] = None) -> None:
     """
     Reads each line from a .txt file, and then
     parses each string to yield a tokenized list of strings for printing, joined by _ characters
     In the case of a non-valid line, the corresponding error message is printed.
     :param fp: The file path of the lines to parse
+    :param cache: If given, lines are tokenized through this ParseCache or DiskParseCache
     """
-    lines = read_lines_from_txt(fp)
-    valid_lines = []
+    inst = instrumentation
+    lines = iter_lines_from_txt(fp)
+    if inst is not None:
+        lines = inst.timed_lines(lines)
+    line_count = 0
+    valid_count = 0
     for l in lines:
-        tokens = parse_tokens(l)
-        if tokens:
-            valid_lines.append(l)
-            print(f"The tokenized string for input string '{l}' is {'_'.join(tokens)}")
-    if len(valid_lines) == len(lines):
+        line_count += 1
+        if inst is not None:
+            start = time.perf_counter()
+        result = tokenize(l) if cache is None else cache.tokenize(l)
+        if inst is not None:
+            inst.record("parse_tokens", time.perf_counter() - start)
+        if result:
+            valid_count += 1
+        print(validity_text(l, result))
+        if inst is not None:
+            inst.end_line(len(result.tokens) if result else 0)
+    if valid_count == line_count:
         print(f"All lines are valid")
     else:
         print(f"Some lines are invalid")
 
 
-def read_lines_from_txt_output_parse_tree(fp: [str, os.PathLike]) -> None:
-    lines = read_lines_from_txt(fp)
+def count_errors(lines: Iterable[str]) -> Counter:
+    """
+    Tokenizes every line without printing anything.
+    :param lines: The lines to parse
+    :return: How many lines ended with each error code of error_messages, valid lines
+    are counted under None
+    """
+    return Counter(tokenize(l).error for l in lines)
+
+
+def check_validity_chunk(lines: List[str]) -> Tuple[int, str]:
+    """
+    Worker of read_lines_from_txt_check_validity_parallel, checks one chunk of lines.
+    :param lines: The lines to parse
+    :return: The number of valid lines, and the text that checking them prints
+    """
+    valid_count = 0
+    out = []
+    for l in lines:
+        result = tokenize(l)
+        if result:
+            valid_count += 1
+        out.append(validity_text(l, result) + "\n")
+    return valid_count, "".join(out)
+
+
+def read_lines_from_txt_check_validity_parallel(fp: Union[str, os.PathLike], workers: Optional[int] = None,
+                                                chunk_size: int = 1000) -> None:
+    """
+    Same as read_lines_from_txt_check_validity, but chunks of lines are checked by a pool
+    of worker processes. Results are printed in input order, and at most two chunks per
+    worker are read ahead of the output.
+    :param fp: The file path of the lines to parse
+    :param workers: Number of worker processes, defaults to the number of CPUs
+    :param chunk_size: Number of lines sent to a worker at a time
+    """
+    workers = workers or os.cpu_count() or 1
+    lines = iter_lines_from_txt(fp)
+    line_count = 0
+    valid_count = 0
+    pending = deque()
+
+    def print_next() -> None:
+        nonlocal valid_count
+        count, text = pending.popleft().get()
+        valid_count += count
+        print(text, end="")
+
+    with multiprocessing.Pool(workers) as pool:
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            line_count += len(chunk)
+            pending.append(pool.apply_async(check_validity_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                print_next()
+        while pending:
+            print_next()
+
+    if valid_count == line_count:
+        print(f"All lines are valid")
+    else:
+        print(f"Some lines are invalid")
+
+
+def read_lines_from_txt_output_parse_tree(fp: [str, os.PathLike],
+                                          cache: Union['ParseCache', 'DiskParseCache', None] = None) -> None:
+    inst = instrumentation
+    lines = iter_lines_from_txt(fp)
+    if inst is not None:
+        lines = inst.timed_lines(lines)
     for line in lines:
-        tokens = parse_tokens(line)
-        if tokens:
-            parse_tree = build_parse_tree(tokens)
+        if inst is not None:
+            start = time.perf_counter()
+        if cache is None:
+            result = tokenize(line)
+        else:
+            # One lookup per line, the cached tree comes with the result
+            result, cached_tree = cache.parse(line)
+        if inst is not None:
+            inst.record("parse_tokens", time.perf_counter() - start)
+            token_count = len(result.tokens) if result else 0
+        parse_tree = None
+        if result:
+            if inst is not None:
+                start = time.perf_counter()
+            parse_tree = build_parse_tree(result.tokens) if cache is None else cached_tree
+            if inst is not None:
+                inst.record("build_parse_tree", time.perf_counter() - start)
+                start = time.perf_counter()
             parse_tree.print_tree()
+            if inst is not None:
+                inst.record("print_tree", time.perf_counter() - start)
         else:
+            print(result.message)
             print(f"Error parsing line: {line}")
+        if inst is not None:
+            inst.end_line(token_count, parse_tree)
 
 
 
@@ -382,16 +968,1070 @@ def build_parse_tree_rec(tokens: List[str]) -> Node:
 
 
 
-def build_parse_tree(tokens: List[str]) -> ParseTree:
+def match_token_brackets(tokens: Sequence, lparen='(', rparen=')') -> List[int]:
+    """
+    :param tokens: Sequence of tokens, or of token ids
+    :param lparen: The '(' token, LPAREN_ID for token ids
+    :param rparen: The ')' token, RPAREN_ID for token ids
+    :return: A list where entry i is the index of the bracket token matching tokens[i],
+    or -1 if tokens[i] is not a bracket or is unmatched
+    """
+    match = [-1] * len(tokens)
+    stack = []
+    for i, t in enumerate(tokens):
+        if t == lparen:
+            stack.append(i)
+        elif t == rparen and stack:
+            j = stack.pop()
+            match[i] = j
+            match[j] = i
+    return match
+
+
+def group_end(match: List[int], start: int, end: int) -> int:
+    """
+    :param match: Bracket match table of the tokens, from match_token_brackets
+    :param start: Index of a '(' token
+    :param end: Index where the group is cut off
+    :return: The index just past the ')' closing the group opened at start, or end if
+    the group is not closed before end
+    """
+    close = match[start]
+    if 0 <= close < end:
+        return close + 1
+    return end
+
+
+# Shared tokens for the '(' and ')' children added around every parenthesized group
+paren_tokens = ('(', ')')
+
+# The '\\', '(' and ')' tokens the tree builders look for and a token they skip, as
+# strings and as SymbolTable ids. Every other token is a variable
+str_syntax = ('\\', '(', ')', '')
+id_syntax = (LAMBDA_ID, LPAREN_ID, RPAREN_ID, None)
+
+
+def list_node(tokens: Sequence[str], start: int, end: int) -> Node:
+    """
+    :return: A Node holding its own copy of tokens[start:end]
+    """
+    return Node(list(tokens[start:end]))
+
+
+def build_nodes_cursor(tokens: Sequence, start: int, end: int,
+                       make_node: Callable[[Sequence, int, int], Node], syntax: tuple = str_syntax) -> Node:
+    """
+    Builds the same tree as build_parse_tree_rec, but walks tokens[start:end] with an
+    index cursor instead of popping from the front of the list, so the token list is
+    never shifted or consumed. Parenthesized groups are pushed on an explicit stack
+    instead of being built by recursive calls, so any nesting depth can be built.
+    :param tokens: Sequence of tokens, or of token ids
+    :param start: Index of the first token of the expression
+    :param end: Index just past the last token of the expression
+    :param make_node: Called as make_node(tokens, start, end) to create every node
+    :param syntax: str_syntax for tokens, id_syntax for token ids
+    :return: The root node of the expression
+    """
+    match = match_token_brackets(tokens, syntax[1], syntax[2])
+    root = make_node(tokens, start, end)
+    stack = [(root, start, end)]  # (node, first token, end) of each expression left to parse
+    while stack:
+        node, pos, end = stack.pop()
+        expand_nodes_cursor(tokens, match, node, pos, end, make_node, stack.append, syntax)
+    return root
+
+
+def expand_nodes_cursor(tokens: Sequence, match: List[int], node: Node, pos: int, end: int,
+                        make_node: Callable[[Sequence, int, int], Node],
+                        defer: Callable[[Tuple[Node, int, int]], None], syntax: tuple = str_syntax) -> None:
+    """
+    Adds the children of node, the expression tokens[pos:end], down to its parenthesized
+    groups. The node of each group is created, but its expression is passed to defer
+    as (node, first token, end) instead of being parsed.
+    :param match: Bracket match table of the tokens, from match_token_brackets
+    :param make_node: Called as make_node(tokens, start, end) to create every node
+    :param defer: Called with every expression left to parse
+    :param syntax: str_syntax for tokens, id_syntax for token ids
+    """
+    lam, lparen, rparen, skip = syntax
+    while pos < end:
+        token = tokens[pos]
+        pos += 1
+
+        if token == lam:
+            if pos >= end:
+                raise IndexError(f"Lambda at token {pos - 1} is not followed by a variable.")
+            node.add_child_node(make_node(tokens, pos - 1, pos))
+            node.add_child_node(make_node(tokens, pos, pos + 1))
+            pos += 1
+            while pos < end and tokens[pos] != lparen:
+                if tokens[pos] != skip:
+                    node.add_child_node(make_node(tokens, pos, pos + 1))
+                pos += 1
+            if pos < end:  # Parenthesized body
+                body_end = group_end(match, pos, end)
+                body = make_node(tokens, pos, body_end)
+                node.add_child_node(body)
+                defer((body, pos, body_end))
+                pos = body_end
+            else:
+                node.add_child_node(make_node(tokens, end, end))
+
+        elif token == lparen:
+            paren_start = pos - 1
+            pos = group_end(match, paren_start, end)
+            paren_exp = make_node(tokens, paren_start, pos)
+            node.add_child_node(paren_exp)
+
+            paren_exp.add_child_node(make_node(paren_tokens, 0, 1))
+            if pos - paren_start == 3:  # This means it's like '(a)'
+                paren_exp.add_child_node(make_node(tokens, paren_start + 1, paren_start + 2))
+            else:
+                inner_end = max(paren_start + 1, pos - 1)  # Remove outer parentheses
+                inner = make_node(tokens, paren_start + 1, inner_end)
+                paren_exp.add_child_node(inner)
+                defer((inner, paren_start + 1, inner_end))
+            paren_exp.add_child_node(make_node(paren_tokens, 1, 2))
+
+        elif token != rparen and token != skip:  # Variable, everything after it goes to the same node
+            node.add_child_node(make_node(tokens, pos - 1, pos))
+            if pos < end and tokens[pos] == lam:
+                # The rest of the tokens from the '\' on become a lambda node
+                lambd = make_node(tokens, pos, end)
+                node.add_child_node(lambd)
+                node = lambd
+
+
+def build_parse_tree_rec_cursor(tokens: List[str], start: int = 0, end: Optional[int] = None) -> Node:
+    """
+    Cursor based build_parse_tree_rec, every node holds its own list of tokens.
+    :param tokens: List of tokens
+    :param start: Index of the first token of the expression
+    :param end: Index just past the last token of the expression, defaults to len(tokens)
+    :return: The root node of the expression
+    """
+    if end is None:
+        end = len(tokens)
+    return build_nodes_cursor(tokens, start, end, list_node)
+
+
+def build_parse_tree_rec_span(tokens: List[str], start: int = 0, end: Optional[int] = None) -> Node:
+    """
+    Cursor based build_parse_tree_rec where every node is a SpanNode into one shared copy
+    of the tokens, so the tree takes memory linear in the number of tokens.
+    :param tokens: List of tokens
+    :param start: Index of the first token of the expression
+    :param end: Index just past the last token of the expression, defaults to len(tokens)
+    :return: The root node of the expression
+    """
+    if end is None:
+        end = len(tokens)
+    return build_nodes_cursor(tuple(tokens), start, end, SpanNode)
+
+
+class LazyNode(SpanNode):
+    """
+    SpanNode whose children are only built when children is first read. Until then
+    match holds the bracket match table of the shared tokens, and reading children
+    parses this node's level with expand_nodes_cursor, leaving its parenthesized groups
+    as new unexpanded LazyNodes. Errors in a group are raised when it is expanded.
+    Attributes:
+        tokens: the shared token sequence
+        start: index of the first token of elem
+        end: index just past the last token of elem
+        match: the bracket match table of tokens, or None once children are built
+    """
+    def __init__(self, tokens: Sequence[str], start: int, end: int):
+        super().__init__(tokens, start, end)
+        self.match = None
+
+    @property
+    def children(self) -> List[Node]:
+        match = self.match
+        if match is not None:
+            self.match = None
+
+            def defer(entry: Tuple['LazyNode', int, int]) -> None:
+                # The deferred expression is always the node's own span
+                entry[0].match = match
+
+            expand_nodes_cursor(self.tokens, match, self, self.start, self.end, LazyNode, defer)
+        return self._children
+
+    @children.setter
+    def children(self, children: List[Node]) -> None:
+        self._children = children
+
+    def expand(self) -> None:
+        """
+        Builds every node under this one, raising the first error in the expression
+        """
+        stack = [self]
+        while stack:
+            stack.extend(stack.pop().children)
+
+
+def build_parse_tree_rec_lazy(tokens: List[str], start: int = 0, end: Optional[int] = None) -> Node:
+    """
+    Builds only the root of the tree build_parse_tree_rec_span would build, as a LazyNode.
+    The bracket match table is built once, after that each level costs time proportional
+    to its own number of children when it is first visited.
+    :param tokens: List of tokens
+    :param start: Index of the first token of the expression
+    :param end: Index just past the last token of the expression, defaults to len(tokens)
+    :return: The root node of the expression
+    """
+    if end is None:
+        end = len(tokens)
+    tokens = tuple(tokens)
+    root = LazyNode(tokens, start, end)
+    root.match = match_token_brackets(tokens)
+    return root
+
+
+class ArrayTree:
+    """
+    A parse tree stored as parallel arrays with one entry per node, node 0 being the root.
+    Attributes:
+        tokens: the tokens of the expression, followed by paren_tokens. With a symbol
+        table, an array('i') of the token ids instead
+        symbols: the SymbolTable of the token ids, or None if tokens holds strings
+        start: index in tokens of the first token of each node's elem
+        end: index in tokens just past the last token of each node's elem
+        parent: index of each node's parent, -1 for the root
+        first_child: index of each node's first child, -1 if it has none
+        next_sibling: index of each node's next sibling, -1 if it has none
+        last_child: index of each node's last child, None once trimmed, after which the
+        last child is found by following next_sibling
+    """
+    def __init__(self, tokens: Sequence, symbols: Optional[SymbolTable] = None, encoded: bool = False):
+        """
+        :param tokens: The tokens of the expression
+        :param symbols: If given, the tree stores token ids from this SymbolTable
+        :param encoded: True if tokens are already ids in symbols, they are stored as given
+        """
+        if symbols is None:
+            self.tokens = tuple(tokens) + paren_tokens
+        else:
+            self.tokens = array('i', tokens) if encoded else symbols.encode(tokens)
+            self.tokens.extend((LPAREN_ID, RPAREN_ID))
+        self.symbols = symbols
+        self.start = array('i')
+        self.end = array('i')
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.last_child = array('i')
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def add_node(self, start: int, end: int) -> int:
+        """
+        :return: The index of a new node without parent or children
+        """
+        self.start.append(start)
+        self.end.append(end)
+        self.parent.append(-1)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        if self.last_child is not None:
+            self.last_child.append(-1)
+        return len(self.start) - 1
+
+    def add_child(self, parent: int, child: int) -> None:
+        self.parent[child] = parent
+        if self.last_child is not None:
+            last = self.last_child[parent]
+            self.last_child[parent] = child
+        else:
+            last = self.first_child[parent]
+            if last >= 0:
+                while self.next_sibling[last] >= 0:
+                    last = self.next_sibling[last]
+        if last < 0:
+            self.first_child[parent] = child
+        else:
+            self.next_sibling[last] = child
+
+    def trim(self) -> None:
+        """
+        Drops the arrays only needed while adding children. Children can still be added,
+        each one walking the siblings of its parent
+        """
+        self.last_child = None
+
+    def elem(self, index: int) -> List[str]:
+        if self.symbols is not None:
+            return self.symbols.decode(self.elem_ids(index))
+        return list(self.tokens[self.start[index]:self.end[index]])
+
+    def elem_ids(self, index: int) -> array:
+        """
+        :return: The token ids of a node's elem, only for trees with a symbol table
+        """
+        return self.tokens[self.start[index]:self.end[index]]
+
+    def children(self, index: int) -> List[int]:
+        result = []
+        child = self.first_child[index]
+        while child >= 0:
+            result.append(child)
+            child = self.next_sibling[child]
+        return result
+
+    def node(self, index: int = 0) -> 'ArrayNode':
+        return ArrayNode(self, index)
+
+    @classmethod
+    def from_arrays(cls, tokens: Sequence, symbols: Optional[SymbolTable], start: Sequence[int],
+                    end: Sequence[int], parent: Sequence[int], first_child: Sequence[int],
+                    next_sibling: Sequence[int]) -> 'ArrayTree':
+        """
+        Wraps existing arrays, e.g. memoryviews of a TreeFile, without copying them.
+        The tree can be read but not added to.
+        """
+        tree = cls.__new__(cls)
+        tree.tokens = tokens
+        tree.symbols = symbols
+        tree.start = start
+        tree.end = end
+        tree.parent = parent
+        tree.first_child = first_child
+        tree.next_sibling = next_sibling
+        tree.last_child = None
+        return tree
+
+
+class ArrayNode:
+    """
+    Node-compatible view of one node of an ArrayTree, created on access.
+    Attributes:
+        tree: the ArrayTree holding the node
+        index: the index of the node in the tree
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: ArrayTree, index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def elem(self) -> List[str]:
+        return self.tree.elem(self.index)
+
+    @property
+    def children(self) -> List['ArrayNode']:
+        return [ArrayNode(self.tree, child) for child in self.tree.children(self.index)]
+
+    def add_child_node(self, node: 'ArrayNode') -> None:
+        self.tree.add_child(self.index, node.index)
+
+
+def build_parse_tree_rec_array(tokens: List[str], start: int = 0, end: Optional[int] = None,
+                               symbols: Optional[SymbolTable] = None) -> ArrayNode:
+    """
+    Cursor based build_parse_tree_rec that stores the tree in an ArrayTree.
+    :param tokens: List of tokens
+    :param start: Index of the first token of the expression
+    :param end: Index just past the last token of the expression, defaults to len(tokens)
+    :param symbols: If given, the tree stores token ids from this SymbolTable
+    :return: A view of the root node, its tree attribute is the ArrayTree
+    """
+    if end is None:
+        end = len(tokens)
+    return build_array_nodes(ArrayTree(tokens, symbols), start, end)
+
+
+def build_array_nodes(tree: ArrayTree, start: int, end: int) -> ArrayNode:
+    """
+    Adds the nodes of the expression tree.tokens[start:end] to an ArrayTree without
+    nodes. A tree with a symbol table is built by comparing its token ids, names are
+    never looked up.
+    :return: A view of the root node
+    """
+    paren_offset = len(tree.tokens) - len(paren_tokens)
+
+    def make_node(source: Sequence, node_start: int, node_end: int) -> ArrayNode:
+        if source is paren_tokens:
+            node_start += paren_offset
+            node_end += paren_offset
+        return ArrayNode(tree, tree.add_node(node_start, node_end))
+
+    root = build_nodes_cursor(tree.tokens, start, end, make_node,
+                              str_syntax if tree.symbols is None else id_syntax)
+    tree.trim()
+    return root
+
+
+def build_parse_tree_ids(token_ids: Sequence[int], symbols: SymbolTable) -> ParseTree:
+    """
+    Build a parse tree from token ids, e.g. from tokenize_ids. The tree is an ArrayTree
+    storing the given ids, the builder compares ids and names are only looked up in
+    symbols when elem is read.
+    :param token_ids: Token ids in symbols
+    :param symbols: The SymbolTable of the ids
+    :return: parse tree
+    """
+    return ParseTree(build_array_nodes(ArrayTree(token_ids, symbols, encoded=True), 0, len(token_ids)))
+
+
+# Parse tree builders that can be selected by name
+tree_builders = {
+    "rec": build_parse_tree_rec,
+    "cursor": build_parse_tree_rec_cursor,
+    "span": build_parse_tree_rec_span,
+    "array": build_parse_tree_rec_array,
+    "lazy": build_parse_tree_rec_lazy,
+}
+
+
+def build_parse_tree(tokens: List[str], builder: str = "span") -> ParseTree:
     """
     Build a parse tree from a list of tokens
     :param tokens: List of tokens
+    :param builder: Name of the tree builder, one of tree_builders. The default builds
+    the tree "rec" builds in time and memory linear in the number of tokens, at any
+    nesting depth. "rec" is only kept as the reference the other builders are tested
+    against
     :return: parse tree
     """
-    pt = ParseTree(build_parse_tree_rec(tokens))
+    if builder not in tree_builders:
+        raise ValueError(f"Unknown tree builder '{builder}', expected one of {sorted(tree_builders)}.")
+    pt = ParseTree(tree_builders[builder](tokens))
     return pt
 
 
+
+def freeze_tree(root: Node) -> None:
+    """
+    Replaces the children list of every node under root with a tuple, so the tree
+    can't be changed through add_child_node or the children lists.
+    :param root: The root of a tree of Node or SpanNode objects
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        node.children = tuple(node.children)
+        stack.extend(node.children)
+
+
+class ParseCache:
+    """
+    Bounded cache of tokenize results and parse trees keyed by input line, evicting
+    the least recently used line when full. Cached results are shared between callers,
+    so results are immutable TokenizeResults holding tuples of tokens, and trees are
+    span trees frozen with freeze_tree. Every call of tokenize, parse or
+    build_parse_tree is one lookup.
+    Attributes:
+        capacity: the maximum number of lines kept
+        hits: the number of lookups of a line already in the cache
+        misses: the number of lookups that had to tokenize the line
+    """
+    def __init__(self, capacity: int = 1024):
+        if capacity < 1:
+            raise ValueError(f"Cache capacity must be at least 1, got {capacity}.")
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()  # line -> [TokenizeResult, ParseTree or None]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, line: str) -> list:
+        """
+        :return: The [result, tree] entry of line, tokenizing it on a miss
+        """
+        entry = self.entries.get(line)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(line)
+            return entry
+        self.misses += 1
+        result = tokenize(line)
+        if result.tokens is not None:
+            result = result._replace(tokens=tuple(result.tokens))
+        entry = [result, None]
+        self.entries[line] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    def tokenize(self, line: str) -> TokenizeResult:
+        """
+        Cached version of tokenize, the tokens of the shared result are a tuple
+        """
+        return self.lookup(line)[0]
+
+    def parse(self, line: str) -> Tuple[TokenizeResult, Optional[ParseTree]]:
+        """
+        :return: The shared result of line and its shared, frozen span tree, or None
+        instead of the tree if line is invalid
+        """
+        entry = self.lookup(line)
+        if entry[1] is None and entry[0]:
+            root = build_parse_tree_rec_span(entry[0].tokens)
+            freeze_tree(root)
+            entry[1] = ParseTree(root)
+        return entry[0], entry[1]
+
+    def build_parse_tree(self, line: str) -> Optional[ParseTree]:
+        """
+        :return: The shared, frozen span tree of line, or None if line is invalid
+        """
+        return self.parse(line)[1]
+
+
+def tokenizer_version() -> int:
+    """
+    :return: A hash of the source of tokenize, the functions it calls and the tables it
+    reads, so any change to them gives a new version. Falls back to the bytecode when
+    the source can't be read
+    """
+    parts = []
+    for fn in (tokenize, match_brackets):
+        try:
+            parts.append(inspect.getsource(fn))
+        except (OSError, TypeError):
+            parts.append(repr((fn.__code__.co_code, fn.__code__.co_consts)))
+    parts.append(repr(sorted(char_classes.items())))
+    parts.append(var_run_re.pattern)
+    # 7 bytes, so the version fits an sqlite INTEGER
+    return int.from_bytes(hashlib.blake2b("\n".join(parts).encode(), digest_size=7).digest(), "little")
+
+
+# Stored with every DiskParseCache, caches written by a different tokenizer are cleared on open
+parser_version = tokenizer_version()
+
+
+class DiskParseCache:
+    """
+    Persistent cache of tokenize results in an sqlite file, keyed by a hash of the input
+    line, so repeated runs over mostly unchanged files skip tokenizing the unchanged
+    lines. Has the tokenize and build_parse_tree methods of ParseCache. When it holds
+    more than capacity lines, the least recently used ones are deleted. Writes are
+    committed every commit_every changes and on close. Use it as a context manager,
+    or call close.
+    Attributes:
+        path: the sqlite file
+        capacity: the maximum number of lines kept
+        hits: the number of lookups of a line already in the cache
+        misses: the number of lookups that had to tokenize the line
+        clock: use counter, stored with each line when it is looked up
+        size: the number of lines in the cache
+        changes: the number of writes since the last commit
+    """
+    def __init__(self, path: Union[str, os.PathLike], capacity: int = 1000000, commit_every: int = 1000):
+        if capacity < 1:
+            raise ValueError(f"Cache capacity must be at least 1, got {capacity}.")
+        self.path = path
+        self.capacity = capacity
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lines (hash BLOB PRIMARY KEY, tokens TEXT, error TEXT, "
+                        "idx INTEGER, detail TEXT, used INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS lines_used ON lines (used)")
+        if self.get_meta("parser_version") != parser_version:
+            self.db.execute("DELETE FROM lines")
+            self.set_meta("parser_version", parser_version)
+        self.clock = self.get_meta("clock") or 0
+        self.size = self.db.execute("SELECT COUNT(*) FROM lines").fetchone()[0]
+        if self.size > self.capacity:
+            self.evict()
+        self.db.commit()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def get_meta(self, key: str) -> Optional[int]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: int) -> None:
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    @staticmethod
+    def line_hash(line: str) -> bytes:
+        return hashlib.blake2b(line.encode(), digest_size=16).digest()
+
+    def tokenize(self, line: str) -> TokenizeResult:
+        """
+        Cached version of tokenize
+        """
+        key = self.line_hash(line)
+        self.clock += 1
+        row = self.db.execute("SELECT tokens, error, idx, detail FROM lines WHERE hash = ?", (key,)).fetchone()
+        if row is not None:
+            self.hits += 1
+            tokens, error, index, detail = row
+            result = TokenizeResult(None if tokens is None else tokens.split(" "), error, index, detail)
+            self.db.execute("UPDATE lines SET used = ? WHERE hash = ?", (self.clock, key))
+        else:
+            self.misses += 1
+            result = tokenize(line)
+            # No token contains a space
+            tokens = None if result.tokens is None else " ".join(result.tokens)
+            self.db.execute("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, tokens, result.error, result.index, result.detail, self.clock))
+            self.size += 1
+            if self.size > self.capacity:
+                self.evict()
+        self.changes += 1
+        if self.changes >= self.commit_every:
+            self.commit()
+        return result
+
+    def parse(self, line: str) -> Tuple[TokenizeResult, Optional[ParseTree]]:
+        """
+        :return: The result of line and its span tree, or None instead of the tree if
+        line is invalid
+        """
+        result = self.tokenize(line)
+        if not result:
+            return result, None
+        return result, ParseTree(build_parse_tree_rec_span(result.tokens))
+
+    def build_parse_tree(self, line: str) -> Optional[ParseTree]:
+        """
+        :return: The span tree of line, or None if line is invalid
+        """
+        return self.parse(line)[1]
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used lines, down to nine tenths of capacity, so
+        eviction runs once per many inserts instead of once per insert. At least the
+        most recently used line is kept
+        """
+        keep = max(1, self.capacity * 9 // 10)
+        self.db.execute("DELETE FROM lines WHERE hash IN (SELECT hash FROM lines ORDER BY used LIMIT ?)",
+                        (self.size - keep,))
+        self.size = keep
+
+    def commit(self) -> None:
+        self.set_meta("clock", self.clock)
+        self.db.commit()
+        self.changes = 0
+
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM lines")
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.commit()
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+    def __enter__(self) -> 'DiskParseCache':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class ConsNode:
+    """
+    Immutable node of a hash-consed parse tree. Nodes are created by a HashConsTable,
+    which returns the same object for structurally identical subtrees, so equality is
+    identity and the hash is computed once.
+    Attributes:
+        elem: a tuple of strings
+        children: a tuple of child ConsNodes
+    """
+    __slots__ = ("elem", "children", "hash")
+
+    def __init__(self, elem: Tuple[str, ...], children: Tuple['ConsNode', ...]):
+        self.elem = elem
+        self.children = children
+        self.hash = hash((elem, children))
+
+    def __hash__(self) -> int:
+        return self.hash
+
+
+class HashConsTable:
+    """
+    Interns parse tree nodes so that every distinct subtree is stored once, turning the
+    trees of a whole corpus into one shared DAG.
+    Attributes:
+        nodes: (elem, children) -> ConsNode of every distinct subtree
+        elems: the distinct elem tuples, so equal elems share one tuple
+        interned: the number of nodes interned, counting repeats
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.elems = {}
+        self.interned = 0
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def sharing_ratio(self) -> float:
+        """
+        :return: Interned nodes per distinct node, 1.0 means nothing is shared
+        """
+        return self.interned / len(self.nodes) if self.nodes else 1.0
+
+    def intern(self, elem: Tuple[str, ...], children: Tuple[ConsNode, ...]) -> ConsNode:
+        """
+        :return: The shared node with this elem and these (already interned) children
+        """
+        self.interned += 1
+        elem = self.elems.setdefault(elem, elem)
+        key = (elem, children)
+        node = self.nodes.get(key)
+        if node is None:
+            node = ConsNode(elem, children)
+            self.nodes[key] = node
+        return node
+
+    def intern_tree(self, root: Node) -> ConsNode:
+        """
+        Interns every node under root, children before their parent.
+        :param root: The root of a tree with the Node interface
+        :return: The shared node for root
+        """
+        results = []  # ConsNode of each finished node
+        # Post-order with an explicit stack: a node's children are read once, as views
+        # like ArrayNode's are new objects on every access, and a (node, child count)
+        # entry takes its children's ConsNodes from the end of results
+        stack = [(root, None)]
+        while stack:
+            node, count = stack.pop()
+            if count is None:
+                children = tuple(node.children)
+                stack.append((node, len(children)))
+                stack.extend((child, None) for child in reversed(children))
+                continue
+            children = tuple(results[len(results) - count:])
+            del results[len(results) - count:]
+            results.append(self.intern(tuple(node.elem), children))
+        return results[0]
+
+
+def build_parse_tree_hashcons(tokens: List[str], table: HashConsTable) -> ParseTree:
+    """
+    Build a parse tree whose nodes are interned in table, shared with every other tree
+    built with the same table
+    :param tokens: List of tokens
+    :param table: The HashConsTable shared by the trees
+    :return: parse tree of ConsNodes
+    """
+    return ParseTree(table.intern_tree(build_parse_tree_rec_span(tokens)))
+
+
+# Binary tree file: a header, the symbol names, then int32 sections, all little-endian
+tree_file_magic = b"LPTF"
+tree_file_version = 1
+tree_file_header = struct.Struct("<4sIIIII")  # magic, version, trees, symbol bytes, tokens, nodes
+tree_file_node_arrays = ("start", "end", "parent", "first_child", "next_sibling")
+
+
+class TreeWriter:
+    """
+    Collects parse trees and writes them to one binary file that TreeFile can load.
+    The file holds one symbol table shared by all trees, the token ids of every tree
+    and the ArrayTree arrays of every tree, each concatenated into one flat array.
+    Node and token indices are relative to the tree they belong to.
+    Attributes:
+        symbols: the SymbolTable shared by the trees
+        tokens: the token ids of all trees
+        nodes: the node arrays of all trees, keyed by tree_file_node_arrays
+        token_offsets: index in tokens of the first token of each tree, plus the end
+        node_offsets: index in the node arrays of the root of each tree, plus the end
+    """
+    def __init__(self):
+        self.symbols = SymbolTable()
+        self.tokens = array('i')
+        self.nodes = {name: array('i') for name in tree_file_node_arrays}
+        self.token_offsets = array('i', [0])
+        self.node_offsets = array('i', [0])
+
+    def __len__(self) -> int:
+        return len(self.token_offsets) - 1
+
+    def add(self, tokens: List[str]) -> None:
+        """
+        Builds and adds the parse tree of a valid token list
+        """
+        self.add_array_tree(build_parse_tree_rec_array(tokens, symbols=self.symbols).tree)
+
+    def add_tree(self, tree: ParseTree) -> None:
+        """
+        Adds a parse tree built by any of the builders. Trees that aren't whole ArrayTrees
+        are stored with a copy of every node's elem.
+        """
+        root = tree.root
+        if isinstance(root, ArrayNode) and root.index == 0:
+            self.add_array_tree(root.tree)
+            return
+        array_tree = ArrayTree([], self.symbols)
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            start = len(array_tree.tokens)
+            array_tree.tokens.extend(self.symbols.intern(t) for t in node.elem)
+            index = array_tree.add_node(start, len(array_tree.tokens))
+            if parent >= 0:
+                array_tree.add_child(parent, index)
+            # Children are pushed in reverse so they are added to their parent in order
+            for child in reversed(node.children):
+                stack.append((child, index))
+        self.add_array_tree(array_tree)
+
+    def add_array_tree(self, tree: ArrayTree) -> None:
+        if tree.symbols is self.symbols:
+            self.tokens.extend(tree.tokens)
+        elif tree.symbols is None:
+            self.tokens.extend(self.symbols.encode(tree.tokens))
+        else:
+            self.tokens.extend(self.symbols.encode(tree.symbols.decode(tree.tokens)))
+        for name in tree_file_node_arrays:
+            self.nodes[name].extend(getattr(tree, name))
+        self.token_offsets.append(len(self.tokens))
+        self.node_offsets.append(len(self.nodes["start"]))
+
+    def write(self, fp: Union[str, os.PathLike]) -> None:
+        names = "\n".join(self.symbols.names).encode()
+        sections = [self.token_offsets, self.node_offsets, self.tokens]
+        sections.extend(self.nodes[name] for name in tree_file_node_arrays)
+        with open(fp, "wb") as f:
+            f.write(tree_file_header.pack(tree_file_magic, tree_file_version, len(self),
+                                          len(names), len(self.tokens), len(self.nodes["start"])))
+            f.write(names + b"\0" * (-len(names) % 4))
+            for section in sections:
+                if sys.byteorder != "little":
+                    section = array('i', section)
+                    section.byteswap()
+                section.tofile(f)
+
+
+class TreeFile:
+    """
+    A file written by TreeWriter, memory-mapped. Indexing it returns a ParseTree of
+    ArrayNodes reading straight from the mapping, so nodes are only created as they
+    are visited and nothing is parsed. Use it as a context manager, or call close.
+    Trees still referenced when it is closed keep the mapping open until they are freed.
+    Attributes:
+        symbols: the SymbolTable shared by the trees
+        tokens: the token ids of all trees
+        nodes: the node arrays of all trees, keyed by tree_file_node_arrays
+        token_offsets: index in tokens of the first token of each tree, plus the end
+        node_offsets: index in the node arrays of the root of each tree, plus the end
+    """
+    def __init__(self, fp: Union[str, os.PathLike]):
+        with open(fp, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, tree_count, names_size, token_count, node_count = \
+            tree_file_header.unpack_from(self.mapping)
+        if magic != tree_file_magic or version != tree_file_version:
+            self.mapping.close()
+            raise ValueError(f"'{fp}' is not a version {tree_file_version} parse tree file.")
+        offset = tree_file_header.size
+        self.symbols = SymbolTable()
+        self.symbols.names = self.mapping[offset:offset + names_size].decode().split("\n")
+        self.symbols.ids = {name: i for i, name in enumerate(self.symbols.names)}
+        offset += names_size + (-names_size % 4)
+
+        view = memoryview(self.mapping)
+
+        def section(count: int) -> Sequence[int]:
+            nonlocal offset
+            data = view[offset:offset + 4 * count].cast('i')
+            offset += 4 * count
+            if sys.byteorder != "little":
+                data = array('i', data)
+                data.byteswap()
+            return data
+
+        self.token_offsets = section(tree_count + 1)
+        self.node_offsets = section(tree_count + 1)
+        self.tokens = section(token_count)
+        self.nodes = {name: section(node_count) for name in tree_file_node_arrays}
+
+    def __len__(self) -> int:
+        return len(self.token_offsets) - 1
+
+    def __getitem__(self, index: int) -> ParseTree:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Tree index {index} out of range.")
+        t0, t1 = self.token_offsets[index], self.token_offsets[index + 1]
+        n0, n1 = self.node_offsets[index], self.node_offsets[index + 1]
+        nodes = [self.nodes[name][n0:n1] for name in tree_file_node_arrays]
+        return ParseTree(ArrayTree.from_arrays(self.tokens[t0:t1], self.symbols, *nodes).node(0))
+
+    def __iter__(self) -> Iterator[ParseTree]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        self.token_offsets = self.node_offsets = self.tokens = None
+        self.nodes = {}
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # Trees still hold views of the mapping
+
+    def __enter__(self) -> 'TreeFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def save_trees(fp: Union[str, os.PathLike], trees: Iterable[ParseTree]) -> int:
+    """
+    Writes trees to a binary tree file, see TreeWriter
+    :return: The number of trees written
+    """
+    writer = TreeWriter()
+    for tree in trees:
+        writer.add_tree(tree)
+    writer.write(fp)
+    return len(writer)
+
+
+class Instrumentation:
+    """
+    Per-stage timings and counters of the file-level functions, recorded while
+    it is the module's instrumentation (see enable_instrumentation). When instrumentation
+    is None, the only cost is one check per stage.
+    Attributes:
+        times: total seconds spent in each stage
+        calls: number of calls of each stage
+        tokens: number of tokens of valid lines
+        trees: number of parse trees built
+        nodes: number of nodes in those trees
+        max_depth: the deepest node level seen in a tree, the root being level 0
+        line_latencies: seconds spent on each line, from reading it to finishing it
+    """
+    stages = ("read_lines_from_txt", "parse_tokens", "build_parse_tree", "print_tree")
+
+    def __init__(self):
+        self.times = Counter()
+        self.calls = Counter()
+        self.tokens = 0
+        self.trees = 0
+        self.nodes = 0
+        self.max_depth = 0
+        self.line_latencies = array('d')
+        self.line_start = 0.0
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+
+    def timed_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        Passes lines through, timing each read as the read_lines_from_txt stage
+        """
+        it = iter(lines)
+        while True:
+            start = time.perf_counter()
+            try:
+                line = next(it)
+            except StopIteration:
+                return
+            self.line_start = time.perf_counter()
+            self.record("read_lines_from_txt", self.line_start - start)
+            yield line
+
+    def end_line(self, token_count: int = 0, tree: Optional[ParseTree] = None) -> None:
+        """
+        Records the latency of the line started by the last read, and counts its
+        tokens and tree
+        """
+        self.line_latencies.append(time.perf_counter() - self.line_start)
+        self.tokens += token_count
+        if tree is not None:
+            self.trees += 1
+            stack = [(tree.root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                self.nodes += 1
+                if depth > self.max_depth:
+                    self.max_depth = depth
+                stack.extend((child, depth + 1) for child in node.children)
+
+    def percentile(self, p: float) -> float:
+        """
+        :param p: Percentile between 0 and 100
+        :return: The line latency in seconds at that percentile (nearest rank)
+        """
+        if not self.line_latencies:
+            return 0.0
+        ordered = sorted(self.line_latencies)
+        rank = max(1, math.ceil(p / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def summary(self) -> str:
+        """
+        :return: A table of the time and calls of each stage, the counters, and the
+        p50 / p95 / p99 line latencies
+        """
+        rows = [f"{'stage':<22}{'calls':>10}{'total s':>12}{'mean us':>12}"]
+        for stage in self.stages:
+            calls = self.calls[stage]
+            total = self.times[stage]
+            mean = total / calls * 1e6 if calls else 0.0
+            rows.append(f"{stage:<22}{calls:>10}{total:>12.4f}{mean:>12.2f}")
+        rows.append(f"lines {len(self.line_latencies)}, tokens {self.tokens}, trees {self.trees}, "
+                    f"nodes {self.nodes}, max depth {self.max_depth}")
+        rows.append("line latency " + ", ".join(f"p{p} {self.percentile(p) * 1e6:.2f} us" for p in (50, 95, 99)))
+        return "\n".join(rows)
+
+    def histogram(self, width: int = 40) -> str:
+        """
+        :param width: Length of the longest bar
+        :return: A text histogram of the line latencies, in power of two microsecond buckets
+        """
+        buckets = Counter(max(0, math.ceil(math.log2(max(t * 1e6, 1e-9)))) for t in self.line_latencies)
+        if not buckets:
+            return "no lines"
+        most = max(buckets.values())
+        rows = []
+        for b in range(min(buckets), max(buckets) + 1):
+            count = buckets[b]
+            rows.append(f"<= {2 ** b:>10} us {count:>10} {'#' * math.ceil(count / most * width)}")
+        return "\n".join(rows)
+
+
+# Instrumentation the file-level functions record into, None when disabled
+instrumentation: Optional[Instrumentation] = None
+
+
+def enable_instrumentation() -> Instrumentation:
+    """
+    :return: A new Instrumentation that the file-level functions record into from now on
+    """
+    global instrumentation
+    instrumentation = Instrumentation()
+    return instrumentation
+
+
+def disable_instrumentation() -> Optional[Instrumentation]:
+    """
+    :return: The Instrumentation that was being recorded into, if any
+    """
+    global instrumentation
+    inst, instrumentation = instrumentation, None
+    return inst
+
 if __name__ == "__main__":
 
     print("\n\nChecking valid examples...")
@@ -0,0 +1,489 @@
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import A1
+import A1_reduce
+from A1_workload import generate_lines
+
+valid_examples_fp = A1.valid_examples_fp
+
+
+def synthetic_long_lines(count: int = 20, length: int = 5000) -> List[str]:
+    """
+    Builds long valid expressions by repeating a mix of the valid example shapes.
+    :param count: Number of lines to build
+    :param length: Approximate number of characters per line
+    :return: A list of valid lambda expression strings
+    """
+    pieces = ["(a b)", "\\x.(x z)", "(\\x(x yz))", "abc", "(a) (b)"]
+    lines = []
+    for n in range(count):
+        parts = []
+        size = 0
+        k = n
+        while size < length:
+            piece = pieces[k % len(pieces)]
+            parts.append(piece)
+            size += len(piece) + 1
+            k += 1
+        lines.append(" ".join(parts))
+    return lines
+
+
+def nested_bracket_lines(count: int = 5, depth: int = 20000) -> List[str]:
+    """
+    :return: Lines of the form (a (a (a ... b))) with depth opening brackets each
+    """
+    return ["(a " * depth + "b" + ")" * depth for _ in range(count)]
+
+
+def time_per_line(fn: Callable, lines: List[str], repeat: int = 5) -> float:
+    """
+    :param fn: Function called once per line
+    :param lines: The input lines
+    :param repeat: Number of passes, the fastest one is kept
+    :return: Best time in seconds for one line, averaged over all lines
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            fn(line)
+        best = min(best, time.perf_counter() - start)
+    return best / len(lines)
+
+
+def bench_tokenizers(name: str, lines: List[str], repeat: int = 5) -> None:
+    """
+    Prints per-line time and throughput of every engine in A1.tokenizer_engines.
+    """
+    print(f"{name}: {len(lines)} lines, {sum(len(l) for l in lines)} chars")
+    baseline = None
+    for engine in A1.tokenizer_engines:
+        per_line = time_per_line(A1.get_tokenizer(engine), lines, repeat)
+        if baseline is None:
+            baseline = per_line
+        print(f"    {engine:<8} {per_line * 1e6:10.2f} us/line {1 / per_line:12.0f} lines/s "
+              f"{baseline / per_line:6.2f}x")
+
+
+def bench_tree_builders(name: str, token_lists: List[List[str]], repeat: int = 3) -> None:
+    """
+    Prints the time each builder in A1.tree_builders takes per token list.
+    A builder that hits the recursion limit is reported instead of timed.
+    """
+    print(f"{name}: {len(token_lists)} token lists, {sum(len(t) for t in token_lists)} tokens")
+    for builder in A1.tree_builders:
+        try:
+            per_list = time_per_line(lambda tokens: A1.build_parse_tree(list(tokens), builder),
+                                     token_lists, repeat)
+        except RecursionError:
+            print(f"    {builder:<8} RecursionError")
+            continue
+        print(f"    {builder:<8} {per_list * 1e6:10.2f} us/tree")
+
+
+def bench_tree_memory(name: str, tokens: List[str]) -> None:
+    """
+    Prints the peak memory each builder in A1.tree_builders allocates for one tree.
+    """
+    print(f"{name}: {len(tokens)} tokens")
+    for builder in A1.tree_builders:
+        tracemalloc.start()
+        try:
+            tree = A1.build_parse_tree(list(tokens), builder)
+        except RecursionError:
+            print(f"    {builder:<8} RecursionError")
+            continue
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print(f"    {builder:<8} {peak / 2 ** 20:10.2f} MiB peak")
+        del tree
+
+
+def visit_levels(root: A1.Node, depth: int) -> int:
+    """
+    :return: The number of nodes in the top depth levels under root, reading only those
+    """
+    count = 0
+    level = [root]
+    for _ in range(depth):
+        count += len(level)
+        level = [child for node in level for child in node.children]
+    return count
+
+
+def bench_shallow_queries(name: str, tokens: List[str], depths: List[int], repeat: int = 3) -> None:
+    """
+    Times building a tree and visiting its top levels with the span builder against
+    the lazy one, which only builds the levels that are visited.
+    """
+    print(f"shallow queries {name}: {len(tokens)} tokens")
+    for depth in depths:
+        times = {}
+        for builder in ("span", "lazy"):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                visit_levels(A1.build_parse_tree(tokens, builder).root, depth)
+                best = min(best, time.perf_counter() - start)
+            times[builder] = best
+        print(f"    depth {depth:>3} span {times['span'] * 1e3:10.3f} ms  lazy {times['lazy'] * 1e3:10.3f} ms "
+              f"{times['span'] / times['lazy']:8.2f}x")
+
+
+def bench_deep_nesting(build_depths: List[int], print_depths: List[int]) -> None:
+    """
+    Stress test for deeply nested terms: times tokenizing and building Church numerals,
+    and printing their trees to os.devnull. Printed text grows with the square of the
+    depth, since every level prints the whole rest of the term, so printing is run on
+    smaller depths.
+    """
+    print("deep nesting")
+    for depth in build_depths:
+        start = time.perf_counter()
+        tokens = A1.parse_tokens_table(A1_reduce.church_numeral(depth))
+        elapsed = time.perf_counter() - start
+        print(f"    depth {depth:>8} tokenize {elapsed:8.3f} s")
+        for builder in ("span", "array"):
+            start = time.perf_counter()
+            A1.build_parse_tree(tokens, builder)
+            elapsed = time.perf_counter() - start
+            print(f"    depth {depth:>8} build {builder:<8} {elapsed:8.3f} s")
+    for depth in print_depths:
+        tree = A1.build_parse_tree(A1.parse_tokens_table(A1_reduce.church_numeral(depth)), "span")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            tree.print_tree()
+            elapsed = time.perf_counter() - start
+        print(f"    depth {depth:>8} print_tree {elapsed:8.3f} s")
+
+
+def bench_parallel_validity(lines: List[str], worker_counts: List[int], chunk_size: int = 2000) -> None:
+    """
+    Times read_lines_from_txt_check_validity against the parallel version for several
+    worker counts, with output sent to os.devnull.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"parallel validity: {len(lines)} lines")
+    try:
+        runs = [("sequential", lambda: A1.read_lines_from_txt_check_validity(f.name))]
+        for workers in worker_counts:
+            runs.append((f"{workers} workers", lambda workers=workers:
+                         A1.read_lines_from_txt_check_validity_parallel(f.name, workers, chunk_size)))
+        baseline = None
+        for name, run in runs:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+            if baseline is None:
+                baseline = elapsed
+            print(f"    {name:<12} {elapsed:8.3f} s {baseline / elapsed:6.2f}x")
+    finally:
+        os.remove(f.name)
+
+
+def bench_render(trees: List[A1.ParseTree]) -> None:
+    """
+    Times print_tree called per tree against render_trees, both writing to os.devnull.
+    """
+    print(f"rendering: {len(trees)} trees")
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for tree in trees:
+                tree.print_tree()
+            elapsed = time.perf_counter() - start
+        print(f"    print_tree   {elapsed:8.3f} s")
+        start = time.perf_counter()
+        A1.render_trees(trees, devnull)
+        elapsed = time.perf_counter() - start
+        print(f"    render_trees {elapsed:8.3f} s")
+
+
+def time_stages(lines: List[str], builder: str = "span") -> Dict[str, float]:
+    """
+    Times the three stages separately over lines: parse_tokens on every line,
+    build_parse_tree on every valid line and print_tree on every tree, with
+    everything printed sent to os.devnull. Valid lines whose tree can't be built are
+    left out of the last two stages.
+    :return: Seconds per stage, plus the number of tokens, trees and skipped lines
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        token_lists = [A1.parse_tokens(l) for l in lines]
+        tokenize_time = time.perf_counter() - start
+
+        token_lists = [t for t in token_lists if t]
+        trees = []
+        skipped = 0
+        start = time.perf_counter()
+        for tokens in token_lists:
+            try:
+                trees.append(A1.build_parse_tree(tokens, builder))
+            except (IndexError, RecursionError):
+                skipped += 1
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for tree in trees:
+            tree.print_tree()
+        print_time = time.perf_counter() - start
+    return {"parse_tokens": tokenize_time, "build_parse_tree": build_time, "print_tree": print_time,
+            "tokens": sum(len(t) for t in token_lists), "trees": len(trees), "skipped": skipped}
+
+
+def bench_stages(name: str, lines: List[str], builder: str = "span") -> None:
+    """
+    Prints time and throughput of each stage over lines.
+    """
+    stages = time_stages(lines, builder)
+    print(f"{name}: {len(lines)} lines, {stages['tokens']} tokens, {stages['trees']} trees, "
+          f"{stages['skipped']} trees skipped, builder {builder}")
+    for stage in ("parse_tokens", "build_parse_tree", "print_tree"):
+        elapsed = stages[stage]
+        print(f"    {stage:<16} {elapsed:8.3f} s {len(lines) / elapsed:12.0f} lines/s "
+              f"{stages['tokens'] / elapsed:12.0f} tokens/s")
+
+
+def bench_scaling(lengths: List[int], count: int = 200, seed: int = 0, builder: str = "span", **params) -> None:
+    """
+    Prints how the time per line of each stage grows with expression length, on
+    generated valid lines.
+    :param lengths: The expression lengths (number of variables) to measure
+    :param count: Number of lines per length
+    :param params: Further WorkloadGenerator parameters
+    """
+    print(f"scaling: {count} lines per length, builder {builder}, {params or 'default parameters'}")
+    print(f"    {'length':>8} {'chars':>8} {'parse_tokens':>14} {'build':>14} {'print':>14}  (us/line)")
+    for length in lengths:
+        lines = generate_lines(count, seed, length=length, **params)
+        stages = time_stages(lines, builder)
+        chars = sum(len(l) for l in lines) // len(lines)
+        trees = max(stages["trees"], 1)
+        print(f"    {length:>8} {chars:>8} {stages['parse_tokens'] / len(lines) * 1e6:14.1f} "
+              f"{stages['build_parse_tree'] / trees * 1e6:14.1f} {stages['print_tree'] / trees * 1e6:14.1f}")
+
+
+def bench_incremental(text: str, edits: int = 2000, seed: int = 0) -> None:
+    """
+    Simulates typing into a long expression: each edit inserts one letter into a random
+    variable name, then deletes it again. Times IncrementalTokenizer.edit against running
+    tokenize on the whole edited text.
+    """
+    rng = random.Random(seed)
+    offsets = [i for i, c in enumerate(text) if c.isalpha()]
+    positions = [rng.choice(offsets) for _ in range(edits)]
+    print(f"incremental: {edits} edits of a {len(text)} character expression")
+
+    inc = A1.IncrementalTokenizer(text)
+    start = time.perf_counter()
+    for pos in positions:
+        inc.edit(pos, 0, "q")
+        inc.edit(pos, 1, "")
+    elapsed = time.perf_counter() - start
+    print(f"    incremental  {elapsed / (2 * edits) * 1e6:10.2f} us/edit "
+          f"({inc.incremental_edits} incremental, {inc.full_tokenizations} full)")
+
+    start = time.perf_counter()
+    for pos in positions:
+        A1.tokenize(text[:pos] + "q" + text[pos:])
+        A1.tokenize(text)
+    elapsed = time.perf_counter() - start
+    print(f"    full         {elapsed / (2 * edits) * 1e6:10.2f} us/edit")
+
+
+def walk_tree(tree: A1.ParseTree) -> int:
+    """
+    Reads the elem of every node, without rendering.
+    :return: The number of tokens in all elems
+    """
+    count = 0
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        count += len(node.elem)
+        stack.extend(node.children)
+    return count
+
+
+def bench_tree_file(name: str, lines: List[str], builder: str = "span") -> None:
+    """
+    Times loading a file written by A1.TreeWriter against re-running tokenize and
+    build_parse_tree on the lines, both for opening every tree and for walking every node.
+    Lines whose tree can't be built are left out.
+    """
+    writer = A1.TreeWriter()
+    built = []
+    for line in lines:
+        result = A1.tokenize(line)
+        if result:
+            try:
+                writer.add(result.tokens)
+            except (IndexError, RecursionError):
+                continue
+            built.append(line)
+    lines = built
+    with tempfile.NamedTemporaryFile(suffix=".lptf", delete=False) as f:
+        pass
+    try:
+        start = time.perf_counter()
+        writer.write(f.name)
+        write_time = time.perf_counter() - start
+        print(f"tree file {name}: {len(lines)} trees, {os.path.getsize(f.name)} bytes, "
+              f"written in {write_time:.3f} s")
+
+        def reparse(walk: bool) -> None:
+            for line in lines:
+                tree = A1.build_parse_tree(A1.tokenize(line).tokens, builder)
+                if walk:
+                    walk_tree(tree)
+
+        def load(walk: bool) -> None:
+            with A1.TreeFile(f.name) as tree_file:
+                for tree in tree_file:
+                    if walk:
+                        walk_tree(tree)
+
+        for walk in (False, True):
+            what = "walk every node" if walk else "open every tree"
+            times = {}
+            for method, fn in (("reparse", reparse), ("load", load)):
+                start = time.perf_counter()
+                fn(walk)
+                times[method] = time.perf_counter() - start
+            print(f"    {what:<16} reparse {times['reparse']:8.3f} s  load {times['load']:8.3f} s "
+                  f"{times['reparse'] / times['load']:6.2f}x")
+    finally:
+        os.remove(f.name)
+
+
+def bench_church_arithmetic(name: str, op: str, pairs: List[tuple], expected: Callable[[int, int], int]) -> None:
+    """
+    Times converting and normalizing op applied to pairs of Church numerals, and checks
+    that each normal form is the expected numeral.
+    """
+    print(f"church {name}:")
+    for a, b in pairs:
+        text = f"({op}) ({A1_reduce.church_numeral(a)}) ({A1_reduce.church_numeral(b)})"
+        start = time.perf_counter()
+        term, _ = A1_reduce.parse_term(text)
+        convert_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = A1_reduce.normalize(term, max_steps=10 ** 7, max_size=10 ** 7)
+        elapsed = time.perf_counter() - start
+        value = A1_reduce.church_value(result.term) if result else None
+        check = "ok" if value == expected(a, b) else f"got {value if result else result.error}"
+        print(f"    {a:>4} {b:>4} {result.steps:>9} steps {elapsed:8.3f} s {result.steps / elapsed:10.0f} steps/s "
+              f"(parse {convert_time * 1e3:.2f} ms) {check}")
+
+
+def bench_shared_arguments(levels: List[int], n: int = 10, max_steps: int = 2 * 10 ** 6) -> None:
+    """
+    Times normal order reduction against the lazy machine on shared_argument_term, where
+    every level uses its argument twice. Normal order is skipped once it hits max_steps.
+    """
+    print(f"shared arguments: is_zero (mult {n} {n}) under each level")
+    substitution_done = True
+    for level in levels:
+        term, _ = A1_reduce.parse_term(A1_reduce.shared_argument_term(level, n))
+        line = f"    {level:>3} levels"
+        if substitution_done:
+            start = time.perf_counter()
+            result = A1_reduce.normalize(term, max_steps=max_steps)
+            elapsed = time.perf_counter() - start
+            if result:
+                line += f"  normal order {result.steps:>9} betas {elapsed:8.3f} s"
+            else:
+                line += f"  normal order over {max_steps} betas"
+                substitution_done = False
+        else:
+            line += f"  normal order {'skipped':>36}"
+        machine = A1_reduce.LazyMachine()
+        start = time.perf_counter()
+        value = A1_reduce.church_bool(machine.readback(machine.whnf(term)))
+        elapsed = time.perf_counter() - start
+        expected = level > 0 or n == 0
+        print(f"{line}  machine {machine.betas:>6} betas {machine.steps:>7} steps {machine.thunk_hits:>5} hits "
+              f"{elapsed:8.3f} s {'ok' if value == expected else value}")
+
+
+def run_tokenizer_benchmarks() -> None:
+    valid_lines = A1.read_lines_from_txt(valid_examples_fp)
+    bench_tokenizers("valid_examples.txt", valid_lines * 200)
+    bench_tokenizers("synthetic long lines", synthetic_long_lines(), repeat=3)
+    bench_tokenizers("nested brackets", nested_bracket_lines(), repeat=3)
+    bench_incremental(synthetic_long_lines(1)[0])
+
+
+def run_tree_benchmarks() -> None:
+    valid_lines = A1.read_lines_from_txt(valid_examples_fp)
+    bench_tree_builders("valid_examples.txt", [A1.parse_tokens(l) for l in valid_lines] * 50)
+    bench_tree_builders("100k tokens", [A1.parse_tokens(" ".join(["(a b)"] * 25000))], repeat=1)
+    bench_tree_memory("nested brackets", A1.parse_tokens(nested_bracket_lines(1, 250)[0]))
+    bench_render([A1.build_parse_tree(A1.parse_tokens(l), "span") for l in valid_lines] * 2000)
+    bench_shallow_queries("100k tokens", A1.parse_tokens(" ".join(["(a (b c) \\x.(x y))"] * 5000)), [1, 2, 4, 1000])
+    bench_shallow_queries("nested brackets", A1.parse_tokens(nested_bracket_lines(1, 20000)[0]), [1, 2, 4, 100000])
+
+
+def run_parallel_benchmarks() -> None:
+    valid_lines = A1.read_lines_from_txt(valid_examples_fp)
+    cpus = os.cpu_count() or 1
+    bench_parallel_validity(valid_lines * 20000, sorted({1, 2, 4, cpus}))
+
+
+def run_deep_benchmarks() -> None:
+    bench_deep_nesting([10 ** 4, 10 ** 5, 10 ** 6], [10 ** 2, 10 ** 3, 5 * 10 ** 3])
+
+
+def run_stage_benchmarks() -> None:
+    bench_stages("generated, 10% invalid", generate_lines(20000, seed=1, invalid_ratio=0.1))
+    bench_stages("generated, no dots", generate_lines(20000, seed=2, dot_frequency=0.0))
+    bench_scaling([10, 100, 1000, 10000])
+    bench_scaling([10, 100, 1000], lambda_density=0.5, dot_frequency=0.0, max_depth=30)
+
+
+def run_serialize_benchmarks() -> None:
+    bench_tree_file("generated", generate_lines(20000, seed=3))
+    bench_tree_file("synthetic long lines", synthetic_long_lines(200))
+
+
+def run_reduce_benchmarks() -> None:
+    bench_church_arithmetic("plus", A1_reduce.church_plus, [(10, 10), (100, 100), (1000, 1000)],
+                            lambda a, b: a + b)
+    bench_church_arithmetic("mult", A1_reduce.church_mult, [(10, 10), (30, 30), (100, 100)],
+                            lambda a, b: a * b)
+    bench_church_arithmetic("exp", A1_reduce.church_exp, [(2, 8), (2, 10), (3, 7)],
+                            lambda a, b: a ** b)
+    bench_shared_arguments([0, 2, 4, 6, 8, 10, 12, 14, 20, 50])
+
+
+# Benchmark sections that can be selected on the command line
+sections = {
+    "tokenizers": run_tokenizer_benchmarks,
+    "trees": run_tree_benchmarks,
+    "stages": run_stage_benchmarks,
+    "parallel": run_parallel_benchmarks,
+    "deep": run_deep_benchmarks,
+    "serialize": run_serialize_benchmarks,
+    "reduce": run_reduce_benchmarks,
+}
+
+
+if __name__ == "__main__":
+    # python A1_bench.py [section ...], all sections if none are given
+    names = sys.argv[1:] or list(sections)
+    for name in names:
+        if name not in sections:
+            sys.exit(f"Unknown section '{name}', expected one of {list(sections)}.")
+    for name in names:
+        sections[name]()
@@ -0,0 +1,202 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from collections import Counter, deque
+from typing import Iterator, List, Optional, TextIO, Tuple
+
+import A1
+
+# What is checked for each line, the output of a valid line grows in this order
+cli_modes = ["validate", "tokens", "tree"]
+
+# Output formats: text matches what A1.py prints, jsonl is one JSON object per line and
+# summary only prints the counts at the end
+cli_formats = ["text", "jsonl", "summary"]
+
+
+def iter_input_paths(paths: List[str]) -> Iterator[str]:
+    """
+    :param paths: Files, directories or '-' for stdin
+    :return: The files to read in order, directories are replaced by the .txt files
+    under them sorted by path
+    """
+    for path in paths:
+        if path != "-" and os.path.isdir(path):
+            found = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                found.extend(os.path.join(dirpath, name) for name in filenames if name.endswith(".txt"))
+            yield from sorted(found)
+        else:
+            yield path
+
+
+def iter_input_lines(paths: List[str]) -> Iterator[Tuple[str, int, str]]:
+    """
+    Streams the lines of every input, one line held in memory at a time.
+    :param paths: Files, directories or '-' for stdin
+    :return: A generator of (source, line number, stripped line), blank lines are skipped
+    """
+    for path in iter_input_paths(paths):
+        if path == "-":
+            lines = (line.strip() for line in sys.stdin)
+            source = "<stdin>"
+        else:
+            lines = A1.iter_lines_from_txt(path)
+            source = path
+        for number, line in enumerate(lines, 1):
+            if line:
+                yield source, number, line
+
+
+def check_line(line: str, mode: str, fmt: str, builder: str) -> Tuple[Optional[str], str]:
+    """
+    :param line: A non-empty stripped line
+    :param mode: One of cli_modes
+    :param fmt: One of cli_formats, nothing is formatted for summary
+    :param builder: Name of the tree builder, one of A1.tree_builders
+    :return: The error code of the line, a key of A1.error_messages or "tree" if the tree
+    builder failed, None if it is valid, and its output text
+    """
+    result = A1.tokenize(line)
+    error, message = result.error, result.message
+    rendered = None
+    if result and mode == "tree":
+        try:
+            tree = A1.build_parse_tree(result.tokens, builder)
+            # Lazy trees are only built, and can only fail, while rendering or expanding
+            if fmt != "summary":
+                rendered = tree.render()
+            elif isinstance(tree.root, A1.LazyNode):
+                tree.root.expand()
+        except (IndexError, RecursionError):
+            error, message = "tree", f"Error building the parse tree of line: {line}"
+    if fmt == "summary":
+        return error, ""
+
+    if fmt == "jsonl":
+        record = {"expr": line, "valid": error is None}
+        if error is not None:
+            record["error"] = message
+        elif mode != "validate":
+            record["tokens"] = result.tokens
+            if rendered is not None:
+                # Without the blank header lines print_tree starts with
+                record["tree"] = rendered[3:]
+        return error, json.dumps(record) + "\n"
+
+    if error is not None:
+        return error, message + "\n"
+    if mode == "tokens":
+        return None, f"The tokenized string for input string '{line}' is {'_'.join(result.tokens)}\n"
+    if mode == "tree":
+        return None, rendered
+    return None, ""
+
+
+def check_chunk(lines: List[Tuple[str, int, str]], mode: str, fmt: str, builder: str) -> Tuple[Counter, str]:
+    """
+    Checks a chunk of lines, in the main process or a worker.
+    :param lines: (source, line number, line) tuples from iter_input_lines
+    :return: How many lines ended with each error code, valid lines are counted under
+    None, and the output text of the chunk
+    """
+    counts = Counter()
+    parts = []
+    for source, number, line in lines:
+        error, text = check_line(line, mode, fmt, builder)
+        counts[error] += 1
+        if fmt == "jsonl":
+            # Source and line number go first, so a record can be found without reading it all
+            text = f'{{"source": {json.dumps(source)}, "line": {number}, ' + text[1:]
+        parts.append(text)
+    return counts, "".join(parts)
+
+
+def run(paths: List[str], mode: str = "tokens", fmt: str = "text", jobs: int = 1, chunk_size: int = 1000,
+        builder: str = "span", out: TextIO = sys.stdout) -> Counter:
+    """
+    Checks every line of the inputs and writes the output of each line in input order,
+    followed by the counts of valid and invalid lines.
+    :param paths: Files, directories or '-' for stdin
+    :param mode: One of cli_modes
+    :param fmt: One of cli_formats
+    :param jobs: Number of worker processes, lines are checked in this process if 1
+    :param chunk_size: Number of lines sent to a worker at a time
+    :param builder: Name of the tree builder, one of A1.tree_builders
+    :param out: Where the output is written
+    :return: How many lines ended with each error code, valid lines are counted under None
+    """
+    lines = iter_input_lines(paths)
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+    counts = Counter()
+
+    def write(result: Tuple[Counter, str]) -> None:
+        counts.update(result[0])
+        if result[1]:
+            out.write(result[1])
+
+    if jobs <= 1:
+        for chunk in chunks:
+            write(check_chunk(chunk, mode, fmt, builder))
+    else:
+        pending = deque()
+        with multiprocessing.Pool(jobs) as pool:
+            # At most two chunks per worker are read ahead of the output
+            for chunk in chunks:
+                pending.append(pool.apply_async(check_chunk, (chunk, mode, fmt, builder)))
+                if len(pending) >= 2 * jobs:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+
+    if fmt != "jsonl":
+        out.write(format_summary(counts))
+    return counts
+
+
+def format_summary(counts: Counter) -> str:
+    """
+    :param counts: Error code counts returned by run
+    :return: The line counts, with one line per error code that occurred
+    """
+    total = sum(counts.values())
+    valid = counts[None]
+    lines = [f"{total} lines, {valid} valid, {total - valid} invalid\n"]
+    for error, count in sorted(((e, c) for e, c in counts.items() if e is not None), key=lambda item: -item[1]):
+        lines.append(f"    {error}: {count}\n")
+    lines.append("All lines are valid\n" if valid == total else "Some lines are invalid\n")
+    return "".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check lambda expressions, one per line.")
+    parser.add_argument("paths", nargs="*", default=["-"],
+                        help="files, directories of .txt files, or - for stdin (the default)")
+    parser.add_argument("--mode", choices=cli_modes, default="tokens")
+    parser.add_argument("--format", choices=cli_formats, default="text", dest="fmt")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="worker processes, 0 for the CPU count")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="lines sent to a worker at a time")
+    parser.add_argument("--builder", choices=sorted(A1.tree_builders), default="span")
+    args = parser.parse_args(argv)
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    for path in args.paths:
+        if path != "-" and not os.path.exists(path):
+            parser.error(f"No such file or directory: '{path}'")
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    try:
+        counts = run(args.paths, args.mode, args.fmt, jobs, args.chunk_size, args.builder)
+    except BrokenPipeError:
+        # The reader went away, e.g. piped into head
+        sys.stderr.close()
+        return 1
+    return 0 if counts[None] == sum(counts.values()) else 1
+
+
+if __name__ == "__main__":
+    # python A1_cli.py [path ...] [--mode validate|tokens|tree] [--format text|jsonl|summary] [--jobs N]
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import argparse
+import os
+import sys
+from typing import Iterable, Iterator, List, Optional
+
+import A1
+import A1_reduce
+from A1_cli import iter_input_lines
+
+
+def line_key(line: str) -> bytes:
+    """
+    :param line: A stripped line
+    :return: The 16 byte canonical hash of the line's term, or for a line without a term,
+    the line itself padded to more than 16 bytes
+    """
+    result = A1.tokenize(line)
+    if result:
+        try:
+            return A1_reduce.canonical_hash(line, result.tokens)
+        except ValueError:
+            pass
+    # Longer than any hash, so it can't collide with one
+    return b"invalid:" + line.encode() + b"\0" * 16
+
+
+class Deduplicator:
+    """
+    Keeps the first line of every alpha-equivalence class of terms, remembering only the
+    16 byte canonical hash of each class seen, so deduplicating n lines takes one hash
+    set lookup per line instead of comparing pairs. Lines that don't hold a term are
+    deduplicated by their text.
+    Attributes:
+        drop_invalid: if True, lines that don't hold a term are dropped
+        seen: the keys of the lines kept so far
+        lines: number of lines read
+        kept: number of lines kept
+        duplicates: number of lines dropped as duplicates
+        invalid: number of lines that don't hold a term
+    """
+    def __init__(self, drop_invalid: bool = False):
+        self.drop_invalid = drop_invalid
+        self.seen = set()
+        self.lines = 0
+        self.kept = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def unique(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        :return: A generator of the lines whose term wasn't seen before, in input order
+        """
+        seen = self.seen
+        for line in lines:
+            self.lines += 1
+            key = line_key(line)
+            if len(key) > 16:
+                self.invalid += 1
+                if self.drop_invalid:
+                    continue
+            if key in seen:
+                self.duplicates += 1
+                continue
+            seen.add(key)
+            self.kept += 1
+            yield line
+
+    def summary(self) -> str:
+        return (f"{self.lines} lines, {self.kept} kept, {self.duplicates} duplicates, "
+                f"{self.invalid} without a term")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Drop lambda expressions alpha-equivalent to an earlier line.")
+    parser.add_argument("paths", nargs="*", default=["-"],
+                        help="files, directories of .txt files, or - for stdin (the default)")
+    parser.add_argument("--output", "-o", help="file to write the unique lines to, defaults to stdout")
+    parser.add_argument("--drop-invalid", action="store_true", help="drop lines that don't hold a term")
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        if path != "-" and not os.path.exists(path):
+            parser.error(f"No such file or directory: '{path}'")
+
+    dedup = Deduplicator(args.drop_invalid)
+    lines = (line for _, _, line in iter_input_lines(args.paths))
+    out = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        for line in dedup.unique(lines):
+            out.write(line + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(dedup.summary(), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    # python A1_dedup.py [path ...] [-o OUTPUT] [--drop-invalid]
+    sys.exit(main())
@@ -0,0 +1,501 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import A1
+import A1_cli
+import A1_dedup
+import A1_reduce
+import A1_server
+from A1_workload import generate_lines
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def valid_lines() -> list:
+    """
+    :return: Every valid line of valid_examples.txt, and seeded generated lines
+    """
+    lines = A1.read_lines_from_txt(os.path.join(here, "valid_examples.txt"))
+    lines += generate_lines(500, seed=3)
+    return [l for l in lines if A1.tokenize(l)]
+
+
+def printed_tree(tree: A1.ParseTree) -> str:
+    """
+    :return: What tree.print_tree() writes to stdout
+    """
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        tree.print_tree()
+    return out.getvalue()
+
+
+def test_tree_builders_agree():
+    # Every builder must print the same tree as the reference build_parse_tree_rec, and
+    # interning any of them must give the same shared node
+    symbols = A1.SymbolTable()
+    table = A1.HashConsTable()
+    trees = []
+    for line in valid_lines():
+        tokens = A1.tokenize(line).tokens
+        expected = printed_tree(A1.build_parse_tree(list(tokens), "rec"))
+        cons = A1.build_parse_tree_hashcons(list(tokens), table)
+        assert printed_tree(cons) == expected, line
+        built = [A1.build_parse_tree(list(tokens), builder) for builder in A1.tree_builders]
+        built.append(A1.build_parse_tree_ids(symbols.encode(tokens), symbols))
+        for tree in built:
+            assert printed_tree(tree) == expected, line
+            assert table.intern_tree(tree.root) is cons.root, line
+        assert table.intern_tree(cons.root) is cons.root, line
+        trees.append((built[0], cons))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "trees.lptf")
+        A1.save_trees(path, [tree for tree, _ in trees])
+        with A1.TreeFile(path) as tree_file:
+            for loaded, (_, cons) in zip(tree_file, trees):
+                assert table.intern_tree(loaded.root) is cons.root
+
+
+def test_deep_nesting():
+    # Deeper than the recursion limit, which only the reference builder "rec" can't build
+    depth = 1500
+    line = "\\f.\\x." + "f (" * depth + "x" + ")" * depth
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "deep.txt")
+        with open(path, "w") as f:
+            f.write(line + "\n")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            A1.read_lines_from_txt_output_parse_tree(path)
+
+
+def test_array_node_add_child_node():
+    # Nodes can be added to a finished ArrayTree through the Node-compatible facade
+    root = A1.build_parse_tree_rec_array(["a", "(", "b", "c", ")"])
+    tree = root.tree
+    root.add_child_node(A1.ArrayNode(tree, tree.add_node(0, 1)))
+    leaf = root.children[0]
+    leaf.add_child_node(A1.ArrayNode(tree, tree.add_node(2, 3)))
+    assert [node.elem for node in root.children] == [["a"], ["(", "b", "c", ")"], ["a"]]
+    assert [node.elem for node in leaf.children] == [["b"]]
+
+
+def test_build_parse_tree_ids_uses_ids():
+    # The builder must walk the given ids, without going back to names
+    class IdsOnly(A1.SymbolTable):
+        def decode(self, ids):
+            raise AssertionError("decode called while building")
+
+        def intern(self, name):
+            raise AssertionError("intern called while building")
+
+    symbols = IdsOnly()
+    ids = array('i', [A1.LAMBDA_ID, 3, A1.LPAREN_ID, 3, 4, A1.RPAREN_ID])
+    tree = A1.build_parse_tree_ids(ids, symbols)
+    assert list(tree.root.tree.tokens[:len(ids)]) == list(ids)
+    assert [list(node.tree.elem_ids(node.index)) for node in tree.root.children] == \
+           [[A1.LAMBDA_ID], [3], [A1.LPAREN_ID, 3, 4, A1.RPAREN_ID]]
+
+
+def test_lazy_tree_errors_in_summary():
+    # Lazy trees only fail once expanded, the CLI summary must still count them as invalid
+    for line in ("((b\\b)", "((ab\\b)", "a b"):
+        expected = A1_cli.check_line(line, "tree", "summary", "span")
+        assert A1_cli.check_line(line, "tree", "summary", "lazy") == expected, line
+
+
+def test_table_tokenizer_agrees():
+    lines = A1.read_lines_from_txt(os.path.join(here, "valid_examples.txt"))
+    lines += A1.read_lines_from_txt(os.path.join(here, "invalid_examples.txt"))
+    lines += generate_lines(500, seed=4, invalid_ratio=0.5)
+    for line in lines:
+        if not line:
+            continue
+        loop_out, table_out = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(loop_out):
+            loop_tokens = A1.parse_tokens(line)
+        with contextlib.redirect_stdout(table_out):
+            table_tokens = A1.parse_tokens_table(line)
+        assert table_tokens == loop_tokens, line
+        assert table_out.getvalue() == loop_out.getvalue(), line
+
+
+def test_incremental_tokenizer_matches_tokenize():
+    rng = random.Random(5)
+    inserts = ["q", "x1", " ", "Ab ", "(", ")", ".", "\\", "3"]
+    for text in generate_lines(100, seed=6, invalid_ratio=0.2):
+        inc = A1.IncrementalTokenizer(text)
+        for _ in range(20):
+            offset = rng.randrange(len(inc.text) + 1)
+            deleted = rng.randrange(min(3, len(inc.text) - offset) + 1)
+            result = inc.edit(offset, deleted, rng.choice(inserts))
+            expected = A1.tokenize(inc.text)
+            assert (result.tokens, result.error) == (expected.tokens, expected.error), inc.text
+            if result:
+                assert inc.offsets == A1.token_offsets(inc.text, result.tokens), inc.text
+        assert inc.incremental_edits + inc.full_tokenizations == 21
+
+
+def test_tokenize_empty():
+    for line in ("", "   ", "\t"):
+        result = A1.tokenize(line)
+        assert not result and (result.error, result.message) == ("empty", "Empty expression."), repr(line)
+    dedup = A1_dedup.Deduplicator()
+    assert list(dedup.unique(["", "a", ""])) == ["", "a"] and dedup.invalid == 2
+
+
+def test_instrumentation_counters():
+    lines = ["a b", "(a", "\\x.x y"]
+    trees = [A1.build_parse_tree(A1.tokenize(line).tokens) for line in lines if A1.tokenize(line)]
+    levels = []  # Level of every node of the valid lines' trees
+    for tree in trees:
+        stack = [(tree.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            levels.append(depth)
+            stack.extend((child, depth + 1) for child in node.children)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lines.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        inst = A1.enable_instrumentation()
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                A1.read_lines_from_txt_check_validity(path)
+                A1.read_lines_from_txt_output_parse_tree(path)
+        finally:
+            assert A1.disable_instrumentation() is inst
+    assert A1.instrumentation is None
+    assert dict(inst.calls) == {"read_lines_from_txt": 6, "parse_tokens": 6, "build_parse_tree": 2, "print_tree": 2}
+    # Valid lines' tokens are counted by both functions, trees only by the second
+    assert inst.tokens == 2 * sum(len(A1.tokenize(line).tokens or ()) for line in lines)
+    assert (inst.trees, inst.nodes, inst.max_depth) == (2, len(levels), max(levels))
+    assert len(inst.line_latencies) == 6
+    summary = inst.summary()
+    assert f"lines 6, tokens {inst.tokens}, trees 2, nodes {len(levels)}, max depth {max(levels)}" in summary
+    assert all(stage in summary for stage in A1.Instrumentation.stages)
+
+
+def test_instrumentation_percentile_histogram():
+    inst = A1.Instrumentation()
+    assert inst.percentile(50) == 0.0 and inst.histogram() == "no lines"
+    inst.line_latencies.extend([4e-6, 1e-6, 3e-6, 2e-6, 100e-6])
+    assert [inst.percentile(p) for p in (0, 20, 50, 80, 99, 100)] == [1e-6, 1e-6, 3e-6, 4e-6, 100e-6, 100e-6]
+    rows = inst.histogram(width=10).split("\n")
+    # Buckets 1, 2, 4, ..., 128 us: the four lines up to 4 us fill the first three, and
+    # empty buckets up to the 100 us line get an empty bar
+    assert len(rows) == 8
+    assert [int(row.split()[3]) for row in rows] == [1, 1, 2, 0, 0, 0, 0, 1]
+    assert rows[2].endswith("#" * 10) and rows[3].endswith(" ")
+    assert "p50 3.00 us, p95 100.00 us, p99 100.00 us" in inst.summary()
+
+
+def test_parallel_validity_matches_sequential():
+    lines = generate_lines(700, seed=8, invalid_ratio=0.4) + ["", "a"]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lines.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        sequential, parallel = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(sequential):
+            A1.read_lines_from_txt_check_validity(path)
+        # Small chunks, so more chunks are in flight than there are workers
+        with contextlib.redirect_stdout(parallel):
+            A1.read_lines_from_txt_check_validity_parallel(path, workers=2, chunk_size=50)
+    assert parallel.getvalue() == sequential.getvalue()
+    assert sequential.getvalue().endswith("Some lines are invalid\n")
+
+
+def test_parse_cache():
+    cache = A1.ParseCache(capacity=2)
+    assert list(cache.tokenize("a b").tokens) == ["a", "b"]
+    assert cache.tokenize("a b") is cache.tokenize("a b")
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert not cache.tokenize("(a")
+    assert cache.build_parse_tree("(a") is None
+    tree = cache.build_parse_tree("a b")
+    assert printed_tree(tree) == printed_tree(A1.build_parse_tree(["a", "b"], "rec"))
+    # "(a" was used less recently than "a b", so it is evicted first
+    cache.tokenize("c")
+    assert len(cache) == 2 and "(a" not in cache.entries
+
+
+def test_parse_cache_shared_results():
+    # Cached results can't be changed by the callers sharing them
+    cache = A1.ParseCache()
+    result = cache.tokenize("a b")
+    for name in ("tokens", "error"):
+        try:
+            setattr(result, name, None)
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError(f"TokenizeResult.{name} can be set")
+    assert cache.tokenize("a b").tokens == ("a", "b")
+
+
+def test_parse_cache_counts_lines_once():
+    cache = A1.ParseCache()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lines.txt")
+        with open(path, "w") as f:
+            f.write("a b\n(a\n")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            A1.read_lines_from_txt_output_parse_tree(path, cache)
+            assert (cache.hits, cache.misses) == (0, 2)
+            A1.read_lines_from_txt_output_parse_tree(path, cache)
+            A1.read_lines_from_txt_check_validity(path, cache)
+    assert (cache.hits, cache.misses) == (4, 2)
+
+
+def test_disk_parse_cache():
+    lines = generate_lines(200, seed=7, invalid_ratio=0.3)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        with A1.DiskParseCache(path, capacity=1000, commit_every=50) as cache:
+            for line in lines:
+                result = cache.tokenize(line)
+                expected = A1.tokenize(line)
+                assert (result.tokens, result.error, result.message) == \
+                       (expected.tokens, expected.error, expected.message), line
+        with A1.DiskParseCache(path) as cache:
+            for line in lines:
+                result = cache.tokenize(line)
+                assert result.tokens == A1.tokenize(line).tokens, line
+            assert cache.misses == 0 and len(cache) == len(set(lines))
+        with A1.DiskParseCache(path, capacity=50) as cache:
+            assert len(cache) <= 50
+
+
+def test_disk_parse_cache_counts_and_eviction():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        with A1.DiskParseCache(path, capacity=1) as cache:
+            cache.tokenize("a b")
+            cache.tokenize("a b")
+            cache.tokenize("c")
+            cache.tokenize("c")
+            assert (cache.hits, cache.misses, len(cache)) == (2, 2, 1)
+            assert cache.db.execute("SELECT COUNT(*) FROM lines").fetchone()[0] == 1
+            # The used clock moves on every lookup, so "c" is the line kept
+            assert cache.clock == 4
+        with A1.DiskParseCache(path) as cache:
+            cache.tokenize("c")
+            assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_disk_parse_cache_version():
+    # The version follows the tokenizer's source, and a cache of another version is cleared
+    assert A1.parser_version == A1.tokenizer_version()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        with A1.DiskParseCache(path) as cache:
+            cache.tokenize("a b")
+            cache.set_meta("parser_version", A1.parser_version + 1)
+        with A1.DiskParseCache(path) as cache:
+            assert len(cache) == 0
+            assert cache.get_meta("parser_version") == A1.parser_version
+
+
+def test_tree_file_roundtrip():
+    trees = [A1.build_parse_tree(A1.tokenize(line).tokens, "span") for line in valid_lines()]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "trees.lptf")
+        assert A1.save_trees(path, trees) == len(trees)
+        with A1.TreeFile(path) as tree_file:
+            assert len(tree_file) == len(trees)
+            for tree, loaded in zip(trees, tree_file):
+                assert printed_tree(loaded) == printed_tree(tree)
+
+
+def test_dedup_dotted_terms():
+    # Chained dots keep every variable, and a lambda whose body is a lambda has a term
+    lines = ["\\x.\\y.x y", "\\x.\\y.x z", "\\a.\\b.a b", "\\x (\\y (x y))", "\\x.\\y.x", "\\y.\\x.y"]
+    dedup = A1_dedup.Deduplicator()
+    assert list(dedup.unique(lines)) == ["\\x.\\y.x y", "\\x.\\y.x z", "\\x.\\y.x"]
+    assert (dedup.duplicates, dedup.invalid) == (3, 0)
+
+
+def test_parse_term_dotted():
+    # A dotted body ends with the bracket group around it, or with the line
+    for text, expected in (("(\\x.x) y", "(\\x (x)) y"), ("\\x.\\y.x y", "\\x (\\y (x y))"),
+                           ("\\f.\\x.f (f x)", "\\f (\\x (f (f x)))"), ("a (\\x.b x) c", "a (\\x (b x)) c")):
+        assert A1_reduce.term_to_text(*A1_reduce.parse_term(text)) == expected, text
+    for text in ("((a)", "\\x.", "()"):
+        try:
+            A1_reduce.parse_term(text)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"parse_term read '{text}'")
+
+
+def test_church_arithmetic():
+    for op, fn in ((A1_reduce.church_plus, lambda a, b: a + b), (A1_reduce.church_mult, lambda a, b: a * b),
+                   (A1_reduce.church_exp, lambda a, b: a ** b)):
+        for a, b in ((0, 2), (1, 3), (2, 5), (3, 3)):
+            text = f"({op}) ({A1_reduce.church_numeral(a)}) ({A1_reduce.church_numeral(b)})"
+            result = A1_reduce.normalize(A1_reduce.parse_term(text)[0])
+            assert result and A1_reduce.church_value(result.term) == fn(a, b), (op, a, b)
+            # The written normal form parses back to the same term
+            written = A1_reduce.term_to_text(result.term)
+            assert A1_reduce.term_to_text(A1_reduce.parse_term(written)[0]) == written
+    assert A1_reduce.church_value(A1_reduce.parse_term("\\f.\\x.f (f x)")[0]) == 2
+
+
+def test_normalize_step_limit():
+    omega = A1_reduce.parse_term("(\\x.x x) (\\x.x x)")[0]
+    result = A1_reduce.normalize(omega, max_steps=50)
+    assert not result and (result.term, result.steps, result.error) == (None, 50, "steps")
+
+
+def test_canonical_tokens():
+    # Alpha-equivalent terms, and only those, share a canonical form
+    canonical = A1_reduce.canonical_tokens
+    assert canonical("\\x.x y") == canonical("\\z.z y") == ["\\", "@", "0", "y"]
+    assert canonical("\\x (\\y (x y))") == canonical("\\a (\\b (a b))") != canonical("\\x (\\y (y x))")
+    assert canonical("\\x.x y") != canonical("\\x.x z")
+    assert canonical("\\x.\\y.x y") == canonical("\\x (\\y (x y))") != canonical("\\x.\\y.x z")
+    assert canonical("\\x.\\y.x") == ["\\", "\\", "1"]
+
+
+def test_lazy_machine_agrees_with_normalize():
+    machine = A1_reduce.LazyMachine()
+    for text in (f"({A1_reduce.church_mult}) ({A1_reduce.church_numeral(3)}) ({A1_reduce.church_numeral(4)})",
+                 f"({A1_reduce.church_exp}) ({A1_reduce.church_numeral(2)}) ({A1_reduce.church_numeral(3)})",
+                 "(\\x (x y)) (\\z (z z))", "a (\\x (b x)) c",
+                 A1_reduce.shared_argument_term(3, 2), A1_reduce.shared_argument_term(3, 0)):
+        term, free = A1_reduce.parse_term(text)
+        expected = A1_reduce.term_to_text(A1_reduce.normalize(term).term, free)
+        assert A1_reduce.term_to_text(machine.readback(machine.whnf(term)), free) == expected, text
+
+
+def test_lazy_machine_shares_arguments():
+    # Each level's argument is evaluated once, and found evaluated the next time it is
+    # looked up, where substituting it evaluates it twice
+    for levels in (0, 1, 3, 5):
+        term = A1_reduce.parse_term(A1_reduce.shared_argument_term(levels, 2))[0]
+        machine = A1_reduce.LazyMachine()
+        value = machine.readback(machine.whnf(term))
+        assert A1_reduce.church_bool(value) == (levels > 0)
+        assert machine.thunk_hits == levels + 1
+        assert machine.betas < A1_reduce.normalize(term).steps or levels == 0
+
+
+def test_lazy_machine_step_limit():
+    omega = A1_reduce.parse_term("(\\x.x x) (\\x.x x)")[0]
+    machine = A1_reduce.LazyMachine(max_steps=1000)
+    try:
+        machine.whnf(omega)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("whnf of omega returned")
+
+
+class MemoryWriter:
+    """
+    The part of asyncio.StreamWriter that ParseServer.handle uses, collecting the
+    responses
+    """
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    async def wait_closed(self) -> None:
+        pass
+
+    def responses(self) -> list:
+        return [json.loads(line) for line in self.data.splitlines()]
+
+
+class SlowExecutor(ThreadPoolExecutor):
+    """
+    Runs the server's offloaded requests in a thread after a delay, recording them
+    """
+    def __init__(self):
+        super().__init__(1)
+        self.exprs = []
+
+    def submit(self, fn, *args):
+        self.exprs.append(args[0])
+
+        def run():
+            time.sleep(0.2)
+            return fn(*args)
+        return super().submit(run)
+
+
+def serve_lines(server: A1_server.ParseServer, lines: list) -> MemoryWriter:
+    """
+    :return: The writer holding the server's responses to lines, read from memory
+    """
+    async def run() -> MemoryWriter:
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(line + b"\n" for line in lines))
+        reader.feed_eof()
+        writer = MemoryWriter()
+        await server.handle(reader, writer)
+        return writer
+    return asyncio.run(run())
+
+
+def test_server_responses_by_id():
+    # The long expression goes to the pool and is answered after the short ones after it
+    server = A1_server.ParseServer(inline_limit=20)
+    server.executor = SlowExecutor()
+    long_expr = " ".join(["a"] * 20)
+    requests = [{"id": 1, "expr": long_expr, "mode": "tokens"}, {"id": 2, "expr": "a b", "mode": "validate"},
+                {"id": "three", "expr": "(a", "mode": "tokens"}, {"id": 4, "expr": "\\x.x", "mode": "tree"},
+                {"id": 5, "expr": "a", "mode": "nonsense"}, {"id": 6}]
+    try:
+        writer = serve_lines(server, [json.dumps(r).encode() for r in requests] + [b"", b"{not json", b"[1]"])
+    finally:
+        server.executor.shutdown()
+    assert writer.closed and server.executor.exprs == [long_expr]
+    responses = writer.responses()
+    assert [r["id"] for r in responses][-1] == 1 and len(responses) == 8
+    by_id = {r["id"]: r for r in responses if r["id"] is not None}
+    assert by_id[1] == {"id": 1, "valid": True, "tokens": ["a"] * 20}
+    assert by_id[2] == {"id": 2, "valid": True}
+    assert by_id["three"] == {"id": "three", "valid": False, "error": A1.tokenize("(a").message}
+    assert by_id[4]["valid"] and by_id[4]["tokens"] == ["\\", "x", "(", "x", ")"] and by_id[4]["tree"]
+    assert by_id[5]["error"].startswith("Unknown mode 'nonsense'")
+    assert by_id[6]["error"] == "Request has no 'expr' string."
+    assert sorted(r["error"] for r in responses if r["id"] is None) == \
+           ["Request is not valid JSON.", "Request must be a JSON object."]
+
+
+def test_server_worker_pool():
+    # Requests above inline_limit are parsed in a worker process
+    server = A1_server.ParseServer(workers=1, inline_limit=0)
+    server.start()
+    try:
+        writer = serve_lines(server, [json.dumps({"id": 1, "expr": "a (b c)", "mode": "tokens"}).encode()])
+    finally:
+        server.shutdown()
+    assert writer.responses() == [{"id": 1, "valid": True, "tokens": ["a", "(", "b", "c", ")"]}]
+
+
+if __name__ == "__main__":
+    # python A1_parse_test.py runs the tests without pytest, failing with a nonzero exit
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} passed")
@@ -0,0 +1,693 @@
+import hashlib
+from collections import defaultdict
+from typing import List, Optional, Sequence, Tuple, Union
+
+import A1
+
+
+class Var:
+    """
+    Variable of a de Bruijn term
+    Attributes:
+        index: the number of binders between the variable and its own binder. Free
+        variables have indices past every enclosing binder, see term_from_named
+        free: one more than the largest index that escapes the term, 0 if it is closed
+        size: the number of nodes of the term
+    """
+    __slots__ = ("index", "free", "size")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.free = index + 1
+        self.size = 1
+
+
+class Lam:
+    """
+    Abstraction of a de Bruijn term
+    Attributes:
+        body: the body term
+        name: the name the variable was written with, only used for printing
+        free: one more than the largest index that escapes the term, 0 if it is closed
+        size: the number of nodes of the term
+    """
+    __slots__ = ("body", "name", "free", "size")
+
+    def __init__(self, body: 'Term', name: str = "x"):
+        self.body = body
+        self.name = name
+        self.free = body.free - 1 if body.free > 1 else 0
+        self.size = body.size + 1
+
+
+class App:
+    """
+    Application of a de Bruijn term
+    Attributes:
+        fn: the applied term
+        arg: the argument
+        free: one more than the largest index that escapes the term, 0 if it is closed
+        size: the number of nodes of the term
+    """
+    __slots__ = ("fn", "arg", "free", "size")
+
+    def __init__(self, fn: 'Term', arg: 'Term'):
+        self.fn = fn
+        self.arg = arg
+        self.free = fn.free if fn.free > arg.free else arg.free
+        self.size = fn.size + arg.size + 1
+
+
+Term = Union[Var, Lam, App]
+
+def named_term_from_tokens(s: str, tokens: Optional[Sequence[str]] = None) -> tuple:
+    """
+    Reads the term of a line from its tokens in one pass, without a parse tree. A lambda
+    binds everything after it up to the end of the bracket group around it, and
+    application is left associative. The tokenizer turns every dot into a '(' and closes
+    them all with one ')' at the end of the line. The offsets of the tokens in s tell
+    which '(' came from a dot: such a group ends with the group around it, and the
+    added ')' is skipped. Parse trees are built from the tokens alone, so (\\x.x) y and
+    (\\x (x) y) share a tree and terms can't be read from trees.
+    :param s: A lambda expression
+    :param tokens: The tokens of s from A1.tokenize, s is tokenized if not given
+    :return: The term as nested tuples ("var", name), ("lam", name, body) and ("app", fn, arg)
+    """
+    if tokens is None:
+        result = A1.tokenize(s)
+        if not result:
+            raise ValueError(result.message)
+        tokens = result.tokens
+    offsets = A1.token_offsets(s, tokens)
+    end = len(s.rstrip())
+    # Open groups, innermost last: [kind, binder name, term so far]. Kinds are "root",
+    # "group" for a bracket of s, "dot" for a '(' that replaced a dot, and "lam"
+    frames = [["root", None, None]]
+
+    def close() -> str:
+        kind, name, term = frames.pop()
+        if term is None:
+            raise ValueError("Lambda has an empty body." if kind == "lam" else "Brackets hold no term.")
+        if kind == "lam":
+            term = ("lam", name, term)
+        top = frames[-1]
+        top[2] = term if top[2] is None else ("app", top[2], term)
+        return kind
+
+    i = 0
+    n = len(tokens)
+    while i < n:
+        token = tokens[i]
+        if token == '\\':
+            if i + 1 >= n:
+                raise ValueError("Lambda is not followed by a variable.")
+            frames.append(["lam", tokens[i + 1], None])
+            i += 2
+            continue
+        if token == '(':
+            frames.append(["dot" if s[offsets[i]] == '.' else "group", None, None])
+        elif token == ')':
+            if offsets[i] < end:  # Not the ')' added for the dots
+                while frames[-1][0] != "group":
+                    if frames[-1][0] == "root":
+                        raise ValueError(f"Bracket ) at index {offsets[i]} closes no group.")
+                    close()
+                close()
+        else:
+            top = frames[-1]
+            top[2] = ("var", token) if top[2] is None else ("app", top[2], ("var", token))
+        i += 1
+    while len(frames) > 1:
+        if close() == "group":
+            raise ValueError("Bracket ( is not closed.")
+    if frames[0][2] is None:
+        raise ValueError("Line holds no term.")
+    return frames[0][2]
+
+
+def apply_terms(reversed_terms: list) -> tuple:
+    """
+    :param reversed_terms: Named terms in reverse order
+    :return: The left associated application of the terms
+    """
+    if not reversed_terms:
+        raise ValueError("No terms to apply.")
+    term = reversed_terms[-1]
+    for i in range(len(reversed_terms) - 2, -1, -1):
+        term = ("app", term, reversed_terms[i])
+    return term
+
+
+def term_from_named(named: tuple) -> Tuple[Term, List[str]]:
+    """
+    Converts a named term into a de Bruijn term. A free variable gets the index of the
+    free variable list entry of its name, counted past every binder around it.
+    :param named: A term from named_term_from_tokens
+    :return: The term, and the names of its free variables
+    """
+    bound = defaultdict(list)  # name -> depth of each enclosing binder with that name
+    free_names = []
+    free_ids = {}
+    results = []
+    depth = 0
+    stack = [(named, False)]
+    while stack:
+        term, done = stack.pop()
+        kind = term[0]
+        if kind == "var":
+            name = term[1]
+            if bound[name]:
+                results.append(Var(depth - 1 - bound[name][-1]))
+            else:
+                if name not in free_ids:
+                    free_ids[name] = len(free_names)
+                    free_names.append(name)
+                results.append(Var(depth + free_ids[name]))
+        elif kind == "lam":
+            if done:
+                depth -= 1
+                bound[term[1]].pop()
+                results.append(Lam(results.pop(), term[1]))
+            else:
+                bound[term[1]].append(depth)
+                depth += 1
+                stack.append((term, True))
+                stack.append((term[2], False))
+        elif done:
+            arg = results.pop()
+            results.append(App(results.pop(), arg))
+        else:
+            stack.append((term, True))
+            stack.append((term[2], False))
+            stack.append((term[1], False))
+    return results[0], free_names
+
+
+def canonical_tokens(s: str, tokens: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Canonical form of the term of a line, equal for two lines exactly when their terms
+    are alpha-equivalent. The term is written in prefix order, '\\' for a lambda, '@' for
+    an application, the de Bruijn index of a bound variable and the name of a free one.
+    Names start with a letter, so they can't be mistaken for indices. Takes one pass over
+    the tokens and one over their named term, no de Bruijn term is built.
+    :param s: A valid lambda expression
+    :param tokens: The tokens of s, if already tokenized
+    :return: The canonical tokens
+    """
+    bound = defaultdict(list)  # name -> depth of each enclosing binder with that name
+    out = []
+    depth = 0
+    stack = [named_term_from_tokens(s, tokens)]
+    while stack:
+        term = stack.pop()
+        kind = term[0]
+        if kind == "var":
+            depths = bound[term[1]]
+            out.append(str(depth - 1 - depths[-1]) if depths else term[1])
+        elif kind == "lam":
+            out.append("\\")
+            bound[term[1]].append(depth)
+            depth += 1
+            stack.append(("end", term[1]))
+            stack.append(term[2])
+        elif kind == "app":
+            out.append("@")
+            stack.append(term[2])
+            stack.append(term[1])
+        else:  # End of a lambda body
+            bound[term[1]].pop()
+            depth -= 1
+    return out
+
+
+def canonical_hash(s: str, tokens: Optional[Sequence[str]] = None) -> bytes:
+    """
+    :return: A 16 byte hash of canonical_tokens(s, tokens), equal for alpha-equivalent terms
+    """
+    return hashlib.blake2b(" ".join(canonical_tokens(s, tokens)).encode(), digest_size=16).digest()
+
+
+def map_vars(term: Term, replace, depth: int = 0) -> Term:
+    """
+    Rebuilds term with every variable that escapes it replaced, sharing the subterms
+    that have no such variable.
+    :param term: The term to rebuild
+    :param replace: Called as replace(index, depth) for every variable with index >= depth,
+    the number of binders around it inside term, and returns its replacement
+    :param depth: Binders already around term
+    :return: The rebuilt term
+    """
+    results = []
+    stack = [(term, depth, False)]
+    while stack:
+        t, d, done = stack.pop()
+        if t.free <= d:  # No variable escapes t, so nothing in it changes
+            results.append(t)
+        elif type(t) is Var:
+            results.append(replace(t.index, d))
+        elif type(t) is Lam:
+            if done:
+                results.append(Lam(results.pop(), t.name))
+            else:
+                stack.append((t, d, True))
+                stack.append((t.body, d + 1, False))
+        elif done:
+            arg = results.pop()
+            results.append(App(results.pop(), arg))
+        else:
+            stack.append((t, d, True))
+            stack.append((t.arg, d, False))
+            stack.append((t.fn, d, False))
+    return results[0]
+
+
+def shift(term: Term, by: int) -> Term:
+    """
+    :return: term with every variable that escapes it moved by more binders
+    """
+    if by == 0:
+        return term
+    return map_vars(term, lambda index, depth: Var(index + by))
+
+
+def instantiate(body: Term, arg: Term) -> Term:
+    """
+    Substitutes arg for the variable bound by the lambda whose body is body.
+    :return: The body of the beta reduction (\\. body) arg
+    """
+    def replace(index: int, depth: int) -> Term:
+        if index == depth:
+            return shift(arg, depth)
+        return Var(index - 1)
+
+    return map_vars(body, replace)
+
+
+class NormalizeResult:
+    """
+    Outcome of normalizing one term
+    Attributes:
+        term: the normal form, or None if a limit was reached first
+        steps: the number of beta reductions done
+        error: "steps" or "size" if that limit was reached, None if term is the normal form
+    """
+    __slots__ = ("term", "steps", "error")
+
+    def __init__(self, term: Optional[Term], steps: int, error: Optional[str] = None):
+        self.term = term
+        self.steps = steps
+        self.error = error
+
+    def __bool__(self) -> bool:
+        return self.error is None
+
+
+def normalize(term: Term, max_steps: int = 1000000, max_size: int = 1000000) -> NormalizeResult:
+    """
+    Normal order (leftmost outermost) reduction to normal form. Each term is first
+    reduced to weak head normal form by contracting the redex at the head of its
+    application spine, then the body of a lambda head, or the arguments of a variable
+    head, are normalized left to right. Explicit stacks are used throughout, so deep
+    terms don't hit the recursion limit.
+    :param term: The term to normalize
+    :param max_steps: The most beta reductions done before giving up
+    :param max_size: Give up when a reduced head term has more nodes than this
+    :return: The normal form and the number of steps, or the limit that was reached
+    """
+    steps = 0
+    results = []
+    # ("eval", term) normalizes a term, ("lam", name) and ("app", head, count) rebuild
+    # a lambda or a spine from the finished results
+    stack = [("eval", term)]
+    while stack:
+        frame = stack.pop()
+        kind = frame[0]
+        if kind == "lam":
+            results.append(Lam(results.pop(), frame[1]))
+            continue
+        if kind == "app":
+            count = frame[2]
+            t = frame[1]
+            for arg in results[len(results) - count:]:
+                t = App(t, arg)
+            del results[len(results) - count:]
+            results.append(t)
+            continue
+
+        t = frame[1]
+        args = []  # The spine's arguments, last one first
+        while True:
+            if type(t) is App:
+                args.append(t.arg)
+                t = t.fn
+            elif type(t) is Lam and args:
+                if steps >= max_steps:
+                    return NormalizeResult(None, steps, "steps")
+                t = instantiate(t.body, args.pop())
+                steps += 1
+                if t.size > max_size:
+                    return NormalizeResult(None, steps, "size")
+            else:
+                break
+
+        if type(t) is Lam:
+            stack.append(("lam", t.name))
+            stack.append(("eval", t.body))
+        elif args:
+            stack.append(("app", t, len(args)))
+            # Pushed in this order, so the first argument is normalized first
+            stack.extend(("eval", arg) for arg in args)
+        else:
+            results.append(t)
+    return NormalizeResult(results[0], steps)
+
+
+def term_to_text(term: Term, free_names: Optional[List[str]] = None) -> str:
+    """
+    Writes a term in the input syntax, with every lambda body in brackets so it parses
+    back to the same term. A binder is renamed with a number suffix if its name is a
+    free name or the name of an enclosing binder.
+    :param term: The term to write
+    :param free_names: The names of the free variables, as returned by parse_term.
+    Free variables past the end of the list are written as v0, v1, ...
+    :return: The text of the term
+    """
+    free_names = free_names or []
+    taken = set(free_names)
+    names = []  # Name of each enclosing binder, innermost last
+    parts = []
+    stack = [term]
+    # Entries are a term to write, a string to append, or None to leave a binder
+    while stack:
+        t = stack.pop()
+        if t is None:
+            taken.discard(names.pop())
+        elif type(t) is str:
+            parts.append(t)
+        elif type(t) is Var:
+            if t.index < len(names):
+                parts.append(names[-1 - t.index])
+            else:
+                i = t.index - len(names)
+                parts.append(free_names[i] if i < len(free_names) else f"v{i}")
+        elif type(t) is Lam:
+            name = t.name
+            k = 0
+            while name in taken:
+                k += 1
+                name = f"{t.name}{k}"
+            names.append(name)
+            taken.add(name)
+            parts.append(f"\\{name} (")
+            stack.extend((None, ")", t.body))
+        else:
+            # Brackets around a lambda in function position and any non-variable argument
+            stack.append(t.arg if type(t.arg) is Var else ")")
+            if type(t.arg) is not Var:
+                stack.extend((t.arg, "("))
+            stack.append(" ")
+            if type(t.fn) is Lam:
+                stack.extend((")", t.fn, "("))
+            else:
+                stack.append(t.fn)
+    return "".join(parts)
+
+
+def parse_term(s: str) -> Tuple[Term, List[str]]:
+    """
+    Tokenizes s and converts its tokens into a de Bruijn term
+    :param s: A valid lambda expression
+    :return: The term, and the names of its free variables
+    """
+    return term_from_named(named_term_from_tokens(s))
+
+
+class Thunk:
+    """
+    A term and the environment it is evaluated in, evaluated at most once
+    Attributes:
+        term: the term, None once the value is known
+        env: the environment of term, a linked list (thunk, rest) ending in None
+        value: the weak head normal form, a Closure or a Neutral, or None until forced
+    """
+    __slots__ = ("term", "env", "value")
+
+    def __init__(self, term: Optional[Term], env: Optional[tuple], value=None):
+        self.term = term
+        self.env = env
+        self.value = value
+
+
+class Closure:
+    """
+    Lambda value of the machine
+    Attributes:
+        lam: the Lam term
+        env: the environment of its body, without the bound variable
+    """
+    __slots__ = ("lam", "env")
+
+    def __init__(self, lam: Lam, env: Optional[tuple]):
+        self.lam = lam
+        self.env = env
+
+
+class Neutral:
+    """
+    Value of the machine whose head is a variable that isn't bound to a thunk, applied
+    to unevaluated arguments
+    Attributes:
+        level: the de Bruijn level of the variable. Binders opened by LazyMachine.readback
+        count up from 0, the free variables of the term count down from -1
+        args: the argument thunks, first argument first
+    """
+    __slots__ = ("level", "args")
+
+    def __init__(self, level: int, args: tuple = ()):
+        self.level = level
+        self.args = args
+
+
+class UpdateFrame:
+    """
+    Stack frame of the machine, the value reached when it is on top is stored in thunk
+    """
+    __slots__ = ("thunk",)
+
+    def __init__(self, thunk: Thunk):
+        self.thunk = thunk
+
+
+class LazyMachine:
+    """
+    Call-by-need abstract machine (a lazy Krivine machine). An application pushes a
+    thunk of its argument and its environment, a lambda binds the thunk on top of the
+    stack, and a variable looks up its thunk and evaluates it with an update frame on the
+    stack, so its value is stored the first time and shared by every later use.
+    Arguments that are variables reuse the thunk they are bound to. Terms are never
+    substituted into, so a duplicated argument is evaluated at most once.
+    Attributes:
+        max_steps: the most machine steps of one whnf call before it gives up
+        steps: number of machine steps, one per term visited
+        betas: number of lambdas applied to an argument
+        thunks: number of thunks created
+        thunk_hits: number of variable lookups that found their thunk already evaluated
+        updates: number of thunks evaluated and stored
+    """
+    def __init__(self, max_steps: int = 10000000):
+        self.max_steps = max_steps
+        self.reset()
+
+    def reset(self) -> None:
+        self.steps = 0
+        self.betas = 0
+        self.thunks = 0
+        self.thunk_hits = 0
+        self.updates = 0
+
+    @staticmethod
+    def free_env(count: int) -> Optional[tuple]:
+        """
+        :return: An environment binding free variable k, index k at the top level, to
+        an evaluated thunk of Neutral(-1 - k)
+        """
+        env = None
+        for k in range(count - 1, -1, -1):
+            env = (Thunk(None, None, Neutral(-1 - k)), env)
+        return env
+
+    def whnf(self, term: Term, env: Optional[tuple] = None):
+        """
+        Evaluates term to weak head normal form.
+        :param term: The term
+        :param env: Its environment, defaults to one holding only its free variables
+        :return: A Closure or a Neutral
+        """
+        if env is None:
+            env = self.free_env(term.free)
+        stack = []
+        limit = self.steps + self.max_steps
+        steps = self.steps
+        while True:
+            steps += 1
+            if steps > limit:
+                self.steps = steps
+                raise RuntimeError(f"Machine step limit of {self.max_steps} reached.")
+            kind = type(term)
+            if kind is App:
+                arg = term.arg
+                if type(arg) is Var:
+                    thunk = env
+                    for _ in range(arg.index):
+                        thunk = thunk[1]
+                    stack.append(thunk[0])
+                else:
+                    stack.append(Thunk(arg, env))
+                    self.thunks += 1
+                term = term.fn
+                continue
+            if kind is Var:
+                for _ in range(term.index):
+                    env = env[1]
+                thunk = env[0]
+                value = thunk.value
+                if value is None:
+                    stack.append(UpdateFrame(thunk))
+                    term, env = thunk.term, thunk.env
+                    continue
+                self.thunk_hits += 1
+            else:
+                value = Closure(term, env)
+
+            # Return value to the frames on the stack
+            while stack:
+                top = stack[-1]
+                if type(top) is UpdateFrame:
+                    stack.pop()
+                    thunk = top.thunk
+                    thunk.value = value
+                    thunk.term = thunk.env = None
+                    self.updates += 1
+                elif type(value) is Closure:
+                    stack.pop()
+                    term, env = value.lam.body, (top, value.env)
+                    self.betas += 1
+                    break
+                else:
+                    # Arguments up to the next update frame join the neutral value
+                    args = []
+                    while stack and type(stack[-1]) is not UpdateFrame:
+                        args.append(stack.pop())
+                    value = Neutral(value.level, value.args + tuple(args))
+            else:
+                self.steps = steps
+                return value
+
+    def force(self, thunk: Thunk):
+        """
+        :return: The value of thunk, evaluating and storing it the first time
+        """
+        if thunk.value is None:
+            thunk.value = self.whnf(thunk.term, thunk.env)
+            thunk.term = thunk.env = None
+            self.updates += 1
+        else:
+            self.thunk_hits += 1
+        return thunk.value
+
+    def readback(self, value, depth: int = 0) -> Term:
+        """
+        Normalizes a value fully, by evaluating lambda bodies with their variable bound
+        to a new Neutral and forcing the arguments of neutral values, left to right.
+        :param value: A value returned by whnf
+        :param depth: The number of binders opened around value
+        :return: The normal form as a de Bruijn term
+        """
+        results = []
+        # ("value", value, depth) reads back a value, ("thunk", thunk, depth) forces a
+        # thunk first, ("lam", name) and ("app", head, count) rebuild from the results
+        stack = [("value", value, depth)]
+        while stack:
+            frame = stack.pop()
+            kind = frame[0]
+            if kind == "lam":
+                results.append(Lam(results.pop(), frame[1]))
+            elif kind == "app":
+                t = frame[1]
+                count = frame[2]
+                for arg in results[len(results) - count:]:
+                    t = App(t, arg)
+                del results[len(results) - count:]
+                results.append(t)
+            else:
+                value, depth = frame[1], frame[2]
+                if kind == "thunk":
+                    value = self.force(value)
+                if type(value) is Closure:
+                    env = (Thunk(None, None, Neutral(depth)), value.env)
+                    stack.append(("lam", value.lam.name))
+                    stack.append(("value", self.whnf(value.lam.body, env), depth + 1))
+                else:
+                    head = Var(depth - 1 - value.level)
+                    if value.args:
+                        stack.append(("app", head, len(value.args)))
+                        stack.extend(("thunk", arg, depth) for arg in reversed(value.args))
+                    else:
+                        results.append(head)
+        return results[0]
+
+
+def church_numeral(n: int) -> str:
+    """
+    :return: The Church numeral n written as \\f.\\x.f (f (... (f x)))
+    """
+    return "\\f.\\x." + "f (" * n + "x" + ")" * n
+
+
+def church_value(term: Term) -> Optional[int]:
+    """
+    :return: n if term is the normal form of the Church numeral n, otherwise None
+    """
+    if type(term) is not Lam or type(term.body) is not Lam:
+        return None
+    t = term.body.body
+    n = 0
+    while type(t) is App and type(t.fn) is Var and t.fn.index == 1:
+        t = t.arg
+        n += 1
+    if type(t) is Var and t.index == 0:
+        return n
+    return None
+
+
+# Church arithmetic on numerals
+church_plus = "\\m.\\n.\\f.\\x.m f (n f x)"
+church_mult = "\\m.\\n.\\f.m (n f)"
+church_exp = "\\m.\\n.n m"  # m to the power n
+
+# Church booleans
+church_true = "\\t.\\f.t"
+church_false = "\\t.\\f.f"
+church_is_zero = f"\\n.n (\\z.{church_false}) ({church_true})"
+
+
+def shared_argument_term(levels: int, n: int) -> str:
+    """
+    Builds (\\b.b b (b false true)) ((\\b...) (... (is_zero (mult n n)))), "b or not b"
+    nested levels deep. Each level evaluates its argument twice whichever value it has,
+    so substituting arguments evaluates the innermost one 2 ** levels times.
+    :return: The term, which is true for levels > 0 or n == 0, and false otherwise
+    """
+    text = f"({church_is_zero}) (({church_mult}) ({church_numeral(n)}) ({church_numeral(n)}))"
+    for _ in range(levels):
+        text = f"(\\b.b b (b ({church_false}) ({church_true}))) ({text})"
+    return text
+
+
+def church_bool(term: Term) -> Optional[bool]:
+    """
+    :return: The value of term if it is the normal form of a Church boolean, otherwise None
+    """
+    if type(term) is Lam and type(term.body) is Lam and type(term.body.body) is Var:
+        return {1: True, 0: False}.get(term.body.body.index)
+    return None
@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import A1
+from A1_workload import generate_lines
+
+here = os.path.dirname(os.path.abspath(__file__))
+baseline_fp = os.path.join(here, "A1_regress_baseline.json")
+
+# Implementations of parse_tokens / build_parse_tree in the repo, by name. The first one
+# is the reference the others are compared against
+implementation_files = {
+    "A1": "A1.py",
+    "A1_old": "A1_old.py",
+    "A1_test": "A1_test.py",
+    "test": "test.py",
+    "skeleton": os.path.join("requirement", "A1.py"),
+}
+
+# Stages timed for every implementation that has them
+stages = ("tokenize", "parse_tokens", "build_parse_tree", "build_parse_tree_span")
+
+# Stages faster than this many items per second take less than a microsecond per item,
+# which is within the timing noise of a loop calling them, so they are reported but not
+# compared against the baseline
+max_compared_rate = 1e6
+
+
+def load_implementation(name: str):
+    """
+    Imports an implementation from its file under a name of its own, so requirement/A1.py
+    doesn't replace the A1 module.
+    """
+    spec = importlib.util.spec_from_file_location(f"regress_{name}", os.path.join(here, implementation_files[name]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def regress_workloads() -> Dict[str, List[str]]:
+    """
+    :return: The lines of each workload. Generated workloads are seeded, so every run
+    checks the same lines
+    """
+    examples = A1.read_lines_from_txt(os.path.join(here, "valid_examples.txt"))
+    examples += A1.read_lines_from_txt(os.path.join(here, "invalid_examples.txt"))
+    return {
+        "examples": [l for l in examples if l],
+        "generated": generate_lines(3000, seed=11, invalid_ratio=0.2),
+        "long": generate_lines(100, seed=12, length=200, max_depth=12),
+    }
+
+
+def run_line(module, line: str, out: io.StringIO) -> Optional[List[str]]:
+    """
+    Runs one line through an implementation, writing what it prints and a
+    Sample_Output.txt style line for its result to out.
+    :return: The tokens, or None if the line is invalid or the implementation failed
+    """
+    with contextlib.redirect_stdout(out):
+        try:
+            tokens = module.parse_tokens(line)
+        except Exception as e:
+            print(f"{type(e).__name__} tokenizing '{line}'")
+            return None
+        if not tokens:
+            print(f"Invalid line: {line}")
+            return None
+        print(f"The tokenized string for input string '{line}' is {'_'.join(tokens)}")
+        if hasattr(module, "build_parse_tree"):
+            try:
+                module.build_parse_tree(list(tokens)).print_tree()
+            except Exception as e:
+                print(f"{type(e).__name__} building the parse tree of '{line}'")
+    return list(tokens)
+
+
+def check_outputs(module, lines: List[str]) -> Tuple[str, List[Optional[List[str]]]]:
+    """
+    :return: A digest of everything the implementation printed for lines, and the tokens
+    of each line
+    """
+    out = io.StringIO()
+    tokens = [run_line(module, line, out) for line in lines]
+    return hashlib.blake2b(out.getvalue().encode(), digest_size=16).hexdigest(), tokens
+
+
+def calibration_loop() -> None:
+    """
+    Fixed pure-Python work of the same kind as tokenizing, string indexing, dict lookups
+    and list appends, timed alongside the stages so rates can be compared across runs
+    on a machine whose speed varies
+    """
+    text = "\\x.(x yz) (a b) " * 64
+    classes = {c: i for i, c in enumerate(set(text))}
+    out = []
+    for _ in range(100):
+        for c in text:
+            out.append(classes[c])
+        out.clear()
+
+
+def autorange(run: Callable[[], None], min_time: float = 0.05) -> int:
+    """
+    :return: How many times run must be called for the calls to take at least min_time,
+    so short stages aren't timed below the clock's noise
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        if time.perf_counter() - start >= min_time:
+            return loops
+        loops *= 2
+
+
+def stage_runs(module, lines: List[str], tokens: List[Optional[List[str]]]) -> Dict[str, Tuple[Callable, int]]:
+    """
+    :return: For each stage the implementation has, a function running it once over the
+    workload and the number of items it handles: every line for tokenize and parse_tokens,
+    every line the implementation finds valid for the tree builders. build_parse_tree is
+    timed with the implementation's default builder, build_parse_tree_span with the span
+    builder of A1.tree_builders. Items a stage fails on are left out
+    """
+    runs = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for stage, fn in (("tokenize", getattr(module, "tokenize", None)), ("parse_tokens", module.parse_tokens)):
+            if fn is None:
+                continue
+            ok_lines = []
+            for line in lines:
+                try:
+                    fn(line)
+                    ok_lines.append(line)
+                except Exception:
+                    pass
+            runs[stage] = (lambda fn=fn, ok_lines=ok_lines: [fn(l) for l in ok_lines], len(ok_lines))
+
+        builders = []
+        if hasattr(module, "build_parse_tree"):
+            builders.append(("build_parse_tree", module.build_parse_tree))
+        if "span" in getattr(module, "tree_builders", {}):
+            builders.append(("build_parse_tree_span", module.tree_builders["span"]))
+        for stage, build in builders:
+            token_lists = []
+            for t in tokens:
+                if t:
+                    try:
+                        build(list(t))
+                        token_lists.append(t)
+                    except Exception:
+                        pass
+            if token_lists:
+                runs[stage] = (lambda build=build, token_lists=token_lists: [build(list(t)) for t in token_lists],
+                               len(token_lists))
+    return runs
+
+
+def measure(names: List[str], rounds: int = 15) -> dict:
+    """
+    Runs every implementation on every workload. Timed runs are interleaved in rounds,
+    each starting with a run of calibration_loop. A stage's score in a round is its rate
+    in items per calibration_loop run of that round, and the median over the rounds is
+    kept, so a few rounds slowed down by the machine don't move it.
+    :return: For each workload and implementation, its output digest, the number of
+    lines whose tokens agree with the reference, and the median rate and score of each
+    stage. Each timed run calls a stage or the calibration loop as many times as
+    autorange gives
+    """
+    workloads = regress_workloads()
+    modules = {name: load_implementation(name) for name in names}
+    results = {}
+    timed = []  # (entry, stage, run, count)
+    for workload, lines in workloads.items():
+        results[workload] = {}
+        reference = None
+        for name, module in modules.items():
+            digest, tokens = check_outputs(module, lines)
+            if reference is None:
+                reference = tokens
+            entry = {"lines": len(lines), "output": digest,
+                     "agree": sum(1 for a, b in zip(tokens, reference) if a == b)}
+            results[workload][name] = entry
+            for stage, (run, count) in stage_runs(module, lines, tokens).items():
+                timed.append((entry, stage, run, count))
+
+    rates = [[] for _ in timed]
+    scores = [[] for _ in timed]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        calibration_loops = autorange(calibration_loop)
+        loops = [autorange(run) for _, _, run, _ in timed]
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(calibration_loops):
+                calibration_loop()
+            calibration = (time.perf_counter() - start) / calibration_loops
+            for i, (_, _, run, count) in enumerate(timed):
+                start = time.perf_counter()
+                for _ in range(loops[i]):
+                    run()
+                rate = count * loops[i] / (time.perf_counter() - start)
+                rates[i].append(rate)
+                scores[i].append(rate * calibration)
+    for i, (entry, stage, _, _) in enumerate(timed):
+        entry[stage] = statistics.median(rates[i])
+        entry[stage + "_score"] = statistics.median(scores[i])
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Stages are compared by score, so a run on a slower or busier machine isn't reported
+    as a regression. Stages faster than max_compared_rate in the baseline aren't compared.
+    :param tolerance: The share by which a stage's score may be lower than the baseline
+    :return: A message for each output that changed and each stage that got slower
+    """
+    failures = []
+    for workload, entries in results.items():
+        for name, entry in entries.items():
+            old = baseline.get(workload, {}).get(name)
+            if old is None:
+                failures.append(f"{workload}/{name}: not in the baseline, run with --update")
+                continue
+            if entry["output"] != old["output"]:
+                failures.append(f"{workload}/{name}: output changed ({entry['agree']}/{entry['lines']} lines "
+                                f"agree with the reference, {old['agree']} before)")
+            for stage in stages:
+                key = stage + "_score"
+                if key not in old or old[stage] > max_compared_rate:
+                    continue
+                if entry.get(key, 0.0) < old[key] * (1 - tolerance):
+                    failures.append(f"{workload}/{name}: {stage} score {entry.get(key, 0.0):.1f}, baseline "
+                                    f"{old[key]:.1f}, {1 - entry.get(key, 0.0) / old[key]:.0%} slower")
+    return failures
+
+
+def format_results(results: dict, baseline: Optional[dict] = None) -> str:
+    lines = []
+    for workload, entries in results.items():
+        lines.append(f"{workload}:")
+        for name, entry in entries.items():
+            old = (baseline or {}).get(workload, {}).get(name, {})
+            rates = []
+            for stage in stages:
+                if stage in entry:
+                    key = stage + "_score"
+                    change = f" ({entry[key] / old[key] - 1:+.0%})" if key in old else ""
+                    if entry[stage] > max_compared_rate:
+                        change = " (not compared)" if key in old else ""
+                    rates.append(f"{stage} {entry[stage]:10.0f}/s{change:>8}")
+            lines.append(f"    {name:<10} agree {entry['agree']:>5}/{entry['lines']:<5} " + "  ".join(rates))
+    return "\n".join(lines) + "\n"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check every implementation's output and speed against a baseline.")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--baseline", default=baseline_fp, help="baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="share by which a stage may be slower than the baseline")
+    parser.add_argument("--rounds", type=int, default=15, help="timed runs per stage, the median score is kept")
+    parser.add_argument("--only", nargs="+", choices=list(implementation_files), default=list(implementation_files),
+                        help="implementations to run, the first is the reference")
+    args = parser.parse_args(argv)
+
+    results = measure(args.only, args.rounds)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline), end="")
+
+    if args.update:
+        if baseline is not None:
+            # Keep the entries of implementations that weren't run
+            for workload, entries in baseline.items():
+                for name, entry in entries.items():
+                    results.setdefault(workload, {}).setdefault(name, entry)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if baseline is None:
+        print(f"No baseline at {args.baseline}, run with --update to create one")
+        return 1
+    failures = compare(results, baseline, args.tolerance)
+    for failure in failures:
+        print("FAIL " + failure)
+    if not failures:
+        print("No regressions")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    # python A1_regress.py [--update] [--tolerance 0.3] [--rounds 15] [--only NAME ...]
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import A1
+
+# Request modes, and what the response holds for a valid expression
+server_modes = {
+    "validate": "valid only",
+    "tokens": "valid and tokens",
+    "tree": "valid, tokens and tree",
+}
+
+
+def parse_request(expr: str, mode: str = "tree", builder: str = "span") -> dict:
+    """
+    Parses one expression. Runs in the event loop for short expressions and in a worker
+    process for long ones, so it only takes and returns picklable values.
+    :param expr: The expression to parse
+    :param mode: One of server_modes
+    :param builder: Name of the tree builder, one of A1.tree_builders
+    :return: The response fields: valid, and either error or the tokens and tree
+    """
+    result = A1.tokenize(expr)
+    if not result:
+        return {"valid": False, "error": result.message}
+    response = {"valid": True}
+    if mode == "validate":
+        return response
+    response["tokens"] = result.tokens
+    if mode == "tree":
+        try:
+            # Without the blank header lines print_tree starts with. Lazy trees are only
+            # built, and can only fail, while rendering
+            response["tree"] = A1.build_parse_tree(result.tokens, builder).render()[3:]
+        except (IndexError, RecursionError):
+            return {"valid": True, "tokens": result.tokens, "error": "Error building the parse tree."}
+    return response
+
+
+class StdinReader:
+    """
+    The part of asyncio.StreamReader that ParseServer.handle uses, reading stdin one line
+    at a time in a thread. Stdin may be a regular file, which asyncio can't wrap in a pipe
+    transport, and nothing is read ahead of the lines asked for.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.stdin = sys.stdin.buffer
+
+    async def readuntil(self, separator: bytes = b"\n") -> bytes:
+        loop = asyncio.get_running_loop()
+        line = await loop.run_in_executor(None, self.stdin.readline, self.limit + 1)
+        if len(line) > self.limit:
+            raise asyncio.LimitOverrunError("Request line is too long.", len(line))
+        return line
+
+
+class StdoutWriter:
+    """
+    The part of asyncio.StreamWriter that ParseServer.handle uses, writing to stdout.
+    Stdout may be a regular file, which asyncio can't wrap in a pipe transport.
+    """
+    def __init__(self):
+        self.out = sys.stdout.buffer
+
+    def write(self, data: bytes) -> None:
+        self.out.write(data)
+
+    async def drain(self) -> None:
+        self.out.flush()
+
+    def close(self) -> None:
+        self.out.flush()
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class ParseServer:
+    """
+    Answers JSON lines of the form {"id": ..., "expr": "...", "mode": "tree"} with one JSON
+    line {"id": ..., "valid": ..., "tokens": [...], "tree": "...", "error": "..."} each.
+    Requests of one connection are handled concurrently, and responses are written as
+    they are ready, so they can come back out of order and are matched up by id.
+    Attributes:
+        workers: number of worker processes for long expressions
+        max_pending: requests per connection in progress at once, no more lines are read
+        from a connection until one of them is answered
+        inline_limit: expressions up to this many characters are parsed in the event loop,
+        longer ones are sent to the worker pool
+        max_line: the longest request line accepted, in bytes
+        builder: name of the tree builder, one of A1.tree_builders
+        executor: the worker pool, created by start
+    """
+    def __init__(self, workers: Optional[int] = None, max_pending: int = 64, inline_limit: int = 2000,
+                 max_line: int = 16 * 2 ** 20, builder: str = "span"):
+        if builder not in A1.tree_builders:
+            raise ValueError(f"Unknown tree builder '{builder}', expected one of {sorted(A1.tree_builders)}.")
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.inline_limit = inline_limit
+        self.max_line = max_line
+        self.builder = builder
+        self.executor = None
+
+    def start(self) -> None:
+        if self.executor is None:
+            # Workers are started on demand, after connections have been accepted. Forked
+            # ones would inherit the open client sockets and keep them from closing, so
+            # they are forked from a clean server process where there is one
+            context = None
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def process(self, line: bytes) -> dict:
+        """
+        :param line: One request line
+        :return: The response to it
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"id": None, "error": "Request is not valid JSON."}
+        if not isinstance(request, dict):
+            return {"id": None, "error": "Request must be a JSON object."}
+        response = {"id": request.get("id")}
+        expr = request.get("expr")
+        mode = request.get("mode", "tree")
+        if not isinstance(expr, str):
+            response["error"] = "Request has no 'expr' string."
+        elif mode not in server_modes:
+            response["error"] = f"Unknown mode '{mode}', expected one of {list(server_modes)}."
+        elif len(expr) <= self.inline_limit:
+            response.update(parse_request(expr, mode, self.builder))
+        else:
+            loop = asyncio.get_running_loop()
+            response.update(await loop.run_in_executor(self.executor, parse_request, expr, mode, self.builder))
+        return response
+
+    async def handle(self, reader, writer) -> None:
+        """
+        Serves one connection until the client closes it.
+        """
+        pending = asyncio.Semaphore(self.max_pending)
+        tasks = set()
+
+        async def answer(line: bytes) -> None:
+            try:
+                response = await self.process(line)
+                writer.write(json.dumps(response).encode() + b"\n")
+                # Waits while the client isn't reading, which holds the semaphore and so
+                # stops more requests from being read
+                await writer.drain()
+            finally:
+                pending.release()
+
+        try:
+            while True:
+                await pending.acquire()
+                try:
+                    line = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    line = e.partial
+                except asyncio.LimitOverrunError:
+                    writer.write(json.dumps({"id": None, "error": "Request line is too long."}).encode() + b"\n")
+                    pending.release()
+                    break
+                if not line:
+                    pending.release()
+                    break
+                if not line.strip():
+                    pending.release()
+                    continue
+                task = asyncio.create_task(answer(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await writer.drain()
+        except ConnectionError:
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve_stdio(self) -> None:
+        """
+        Reads requests from stdin and writes responses to stdout, until stdin is closed.
+        """
+        self.start()
+        await self.handle(StdinReader(self.max_line), StdoutWriter())
+
+    async def serve_tcp(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        self.start()
+        server = await asyncio.start_server(self.handle, host, port, limit=self.max_line)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_unix(self, path: str) -> None:
+        self.start()
+        server = await asyncio.start_unix_server(self.handle, path, limit=self.max_line)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Lambda expression parse service over JSON lines.")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--tcp", metavar="HOST:PORT", help="listen on a TCP address")
+    where.add_argument("--unix", metavar="PATH", help="listen on a Unix socket")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--max-pending", type=int, default=64, help="requests in progress per connection")
+    parser.add_argument("--inline-limit", type=int, default=2000,
+                        help="longest expression parsed without the worker pool")
+    parser.add_argument("--builder", choices=sorted(A1.tree_builders), default="span")
+    args = parser.parse_args(argv)
+
+    server = ParseServer(args.workers, args.max_pending, args.inline_limit, builder=args.builder)
+    try:
+        if args.tcp:
+            host, _, port = args.tcp.rpartition(":")
+            asyncio.run(server.serve_tcp(host or "127.0.0.1", int(port)))
+        elif args.unix:
+            asyncio.run(server.serve_unix(args.unix))
+        else:
+            asyncio.run(server.serve_stdio())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # python A1_server.py [--tcp HOST:PORT | --unix PATH], stdin / stdout if neither is given
+    main()
@@ -0,0 +1,147 @@
+import random
+from typing import List, Optional
+
+import A1
+
+# Letters that can end a variable name placed before a dot
+name_letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+name_chars = name_letters + "0123456789"
+
+# Error codes of A1.error_messages that generate_invalid can produce
+invalid_error_types = [
+    "lambda_space",
+    "lambda_no_var",
+    "lambda_no_body",
+    "lambda_at_end",
+    "empty_parens",
+    "unclosed_bracket",
+    "unopened_bracket",
+    "no_var_before_dot",
+    "invalid_dot",
+    "digit_start",
+    "invalid_char",
+]
+
+
+class WorkloadGenerator:
+    """
+    Seeded generator of lambda expressions for benchmarks
+    Attributes:
+        rng: the random number generator, seeded with seed
+        length: the approximate number of variables in an expression
+        max_depth: the maximum nesting of lambdas and parentheses
+        lambda_density: the chance that a term is a lambda abstraction
+        paren_density: the chance that a term is a parenthesized expression
+        dot_frequency: the chance that a lambda uses the dot syntax \\x.body
+        name_length: the maximum length of a variable name
+    """
+    def __init__(self, seed: int = 0, length: int = 20, max_depth: int = 8, lambda_density: float = 0.2,
+                 paren_density: float = 0.2, dot_frequency: float = 0.5, name_length: int = 3):
+        self.rng = random.Random(seed)
+        self.length = length
+        self.max_depth = max_depth
+        self.lambda_density = lambda_density
+        self.paren_density = paren_density
+        self.dot_frequency = dot_frequency
+        self.name_length = name_length
+
+    def name(self) -> str:
+        """
+        :return: A variable name ending in a letter, so it can stand before a dot
+        """
+        rng = self.rng
+        size = rng.randint(1, self.name_length)
+        if size == 1:
+            return rng.choice(name_letters)
+        middle = "".join(rng.choice(name_chars) for _ in range(size - 2))
+        return rng.choice(name_letters) + middle + rng.choice(name_letters)
+
+    def expression(self, budget: Optional[int] = None, depth: int = 0) -> str:
+        """
+        :param budget: Number of variables left for this expression, defaults to length
+        :param depth: Current nesting depth
+        :return: A valid expression, an application of one or more terms
+        """
+        rng = self.rng
+        if budget is None:
+            budget = self.length
+        terms = []
+        while budget > 0:
+            r = rng.random()
+            nested = depth < self.max_depth and budget > 1
+            if nested and r < self.lambda_density:
+                inner = rng.randint(1, budget - 1)
+                budget -= inner + 1
+                head = "\\" + self.name()
+                body = self.expression(inner, depth + 1)
+                if rng.random() < self.dot_frequency:
+                    # The body of \x.body runs to the end, nothing may follow it
+                    terms.append(head + "." + body)
+                    break
+                terms.append(head + rng.choice((" (", "(")) + body + ")")
+            elif nested and r < self.lambda_density + self.paren_density:
+                inner = rng.randint(1, budget)
+                budget -= inner
+                terms.append("(" + self.expression(inner, depth + 1) + ")")
+            else:
+                budget -= 1
+                terms.append(self.name())
+        return " ".join(terms)
+
+    def invalid(self, error: Optional[str] = None) -> str:
+        """
+        :param error: One of invalid_error_types, a random one if None
+        :return: An expression that A1.tokenize rejects with that error code
+        """
+        rng = self.rng
+        if error is None:
+            error = rng.choice(invalid_error_types)
+        s = self.expression()
+        if error == "lambda_space":
+            return "\\ " + self.name() + " " + s
+        if error == "lambda_no_var":
+            return "\\(" + s + ")"
+        if error == "lambda_no_body":
+            return s + " \\" + self.name()
+        if error == "lambda_at_end":
+            return s + " \\"
+        if error == "empty_parens":
+            return "() " + s
+        if error == "unclosed_bracket":
+            return s + " (" + self.name()
+        if error == "unopened_bracket":
+            return ") " + s
+        if error == "no_var_before_dot":
+            return self.name() + " ." + s
+        if error == "invalid_dot":
+            return "." + s
+        if error == "digit_start":
+            return str(rng.randint(0, 9)) + self.name() + " " + s
+        if error == "invalid_char":
+            return rng.choice("+-*/,;#") + s
+        raise ValueError(f"Unknown error type '{error}', expected one of {invalid_error_types}.")
+
+
+def generate_lines(count: int, seed: int = 0, invalid_ratio: float = 0.0, **params) -> List[str]:
+    """
+    :param count: Number of lines
+    :param seed: Random seed, the same seed and parameters give the same lines
+    :param invalid_ratio: Share of lines that are invalid
+    :param params: Further WorkloadGenerator parameters
+    :return: A list of expressions
+    """
+    gen = WorkloadGenerator(seed, **params)
+    return [gen.invalid() if gen.rng.random() < invalid_ratio else gen.expression() for _ in range(count)]
+
+
+if __name__ == "__main__":
+    # Check that the generator produces what it claims
+    gen = WorkloadGenerator(seed=1)
+    for _ in range(2000):
+        s = gen.expression()
+        assert A1.tokenize(s), (s, A1.tokenize(s).message)
+    for error in invalid_error_types:
+        for _ in range(200):
+            s = gen.invalid(error)
+            assert A1.tokenize(s).error == error, (s, error, A1.tokenize(s).message)
+    print("\n".join(generate_lines(10, seed=1, invalid_ratio=0.3)))